@@ -3,6 +3,7 @@ import os
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
+from app.logging import logger, start_writer
 
 webserver = Flask(__name__)
 
@@ -10,10 +11,29 @@ webserver = Flask(__name__)
 if not os.path.exists('results'):
     os.makedirs('results')
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+webserver.config['DATA_CSV'] = "./nutrition_activity_obesity_usa_subset.csv"
+# binary snapshot of the csv file => later starts don't parse it again (TP_SNAPSHOT_DIR='' disables)
+snapshot_dir = os.environ.get('TP_SNAPSHOT_DIR', 'snapshots')
+webserver.config['DATA_SNAPSHOT'] = None
+if snapshot_dir:
+    webserver.config['DATA_SNAPSHOT'] = os.path.join(
+        snapshot_dir, 'nutrition_activity_obesity_usa_subset.snapshot')
+webserver.data_ingestor = DataIngestor(webserver.config['DATA_CSV'],
+                                       snapshot_path=webserver.config['DATA_SNAPSHOT'])
+ingest_stats = webserver.data_ingestor.ingest_stats
+logger.info("Ingested %d rows from %s in %.3f s (%.0f rows/s, %d worker(s))",
+            ingest_stats['rows'], ingest_stats['source'], ingest_stats['seconds'],
+            ingest_stats['rows'] / max(ingest_stats['seconds'], 1e-9), ingest_stats['workers'])
 
 webserver.tasks_runner = ThreadPool(webserver.data_ingestor)
+# every process is forked by now => the log writer thread can start
+start_writer()
 
-webserver.job_counter = 1
+# longest time (seconds) a /api/get_results/<job_id>?wait= request is held open
+webserver.config['MAX_RESULT_WAIT'] = float(os.environ.get('TP_MAX_RESULT_WAIT', 30))
+# inline mode: POST requests return cached or cheap results directly (with their job_id)
+webserver.config['INLINE_RESULTS'] = os.environ.get('TP_INLINE_RESULTS', '0')
+# highest estimated cost (number of precomputed groups read) of a task solved inline
+webserver.config['INLINE_MAX_COST'] = int(os.environ.get('TP_INLINE_MAX_COST', 100))
 
 from app import routes
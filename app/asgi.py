@@ -0,0 +1,281 @@
+""" asgi.py """
+import asyncio
+import io
+import json
+import sys
+import time
+from threading import Thread
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+from app import webserver
+from app.job_registry import SUBSCRIBER_QUEUE_SIZE
+from app.logging import logger, Payload
+from app.routes import BATCH_ENDPOINTS, KEEPALIVE_EVENT, KEEPALIVE_INTERVAL, JobEventStream, \
+    register_job, is_inline, is_timing, get_job_result, get_wait_time, get_http_status, \
+    observe_get_results
+
+async def read_body(receive):
+    """ read whole body of an http request """
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+async def send_json(send, payload, status=200, headers=None):
+    """ send payload as json, formatted like flask's jsonify """
+    body = (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode('latin-1'))] + headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_event(send, event):
+    """ send one server-sent event (text) of a stream, the response goes on """
+    await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+
+def get_wsgi_environ(scope, body):
+    """ WSGI environment of an ASGI http request """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ[key] = value.decode('latin-1')
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            value = value.decode('latin-1')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def run_wsgi(wsgi_app, scope, body):
+    """ answer request with a WSGI application - return (status, headers, body) """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):  # pylint: disable=unused-argument
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+
+    chunks = wsgi_app(get_wsgi_environ(scope, body), start_response)
+    try:
+        response_body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], response_body
+
+
+class JobNotifier:
+    """
+    JobNotifier class - wake up coroutines waiting for jobs
+    One thread reads finished jobs from the JobRegistry and hands them to the event loop,
+    so waiting connections don't hold a thread each
+    """
+    def __init__(self, loop, job_registry):
+        """ subscribe to finished jobs and start the thread that forwards them """
+        self.loop = loop
+        self.job_registry = job_registry
+        # job_id -> futures of coroutines waiting for it
+        self.waiters = {}
+        # queues of event streams, they get every finished job
+        self.streams = set()
+        # read right away by the thread => unbounded; the event streams are bounded
+        self.subscriber = job_registry.subscribe(maxsize=0)
+        self.thread = Thread(target=self.forward_jobs, daemon=True)
+        self.thread.start()
+
+    def forward_jobs(self):
+        """ thread: hand every finished job to the event loop """
+        while True:
+            finished_job = self.subscriber.get()
+            if finished_job is None:
+                # closed
+                break
+            try:
+                self.loop.call_soon_threadsafe(self.job_finished, *finished_job)
+            except RuntimeError:
+                # event loop closed (server stopped) => nobody waits for jobs anymore
+                self.job_registry.unsubscribe(self.subscriber)
+                break
+
+    def close(self):
+        """ stop forwarding finished jobs """
+        self.job_registry.unsubscribe(self.subscriber)
+        self.subscriber.put(None)
+
+    def job_finished(self, job_id, status):
+        """ event loop: wake up coroutines waiting for job_id, send it to event streams """
+        for future in self.waiters.pop(job_id, []):
+            if not future.done():
+                future.set_result(status)
+        for stream in list(self.streams):
+            try:
+                stream.put_nowait((job_id, status))
+            except asyncio.QueueFull:
+                # slow client => its stream ends after the queued events, it doesn't buffer more
+                self.streams.discard(stream)
+                self.job_registry.drop_subscriber()
+
+    async def wait_job(self, job_id, timeout):
+        """ wait until job_id is not running anymore or timeout (seconds) expires """
+        future = self.loop.create_future()
+        self.waiters.setdefault(job_id, []).append(future)
+        # registered before looking at status => the job can't finish unnoticed
+        if self.job_registry.get_status(job_id) == 'running':
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+        futures = self.waiters.get(job_id, [])
+        if future in futures:
+            futures.remove(future)
+            if not futures:
+                del self.waiters[job_id]
+
+
+class AsgiApp:
+    """
+    AsgiApp class - asyncio front end with the same API as the flask webserver
+    Job submission, get_results (also with ?wait=) and events are answered on the event loop,
+    with the same job ids, ThreadPool and responses; other requests are passed to the flask
+    application, in a thread of the default executor
+    """
+    def __init__(self, wsgi_app):
+        """ default constructor """
+        self.wsgi_app = wsgi_app
+        # created with the event loop, on the first request
+        self.notifier = None
+
+    async def __call__(self, scope, receive, send):
+        """ ASGI entry point """
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        loop = asyncio.get_running_loop()
+        if self.notifier is None or self.notifier.loop is not loop:
+            # first request, or the server started a new event loop
+            if self.notifier is not None:
+                self.notifier.close()
+            self.notifier = JobNotifier(loop, webserver.tasks_runner.job_registry)
+        body = await read_body(receive)
+        if not await self.handle(scope, body, send):
+            status, headers, response_body = await loop.run_in_executor(
+                None, run_wsgi, self.wsgi_app, scope, body)
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': response_body})
+
+    async def lifespan(self, receive, send):
+        """ answer startup and shutdown messages of the server """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # before the event loop is closed => the thread doesn't hand it more jobs
+                if self.notifier is not None:
+                    self.notifier.close()
+                    self.notifier = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, body, send):
+        """
+        answer request on the event loop - return False if flask has to answer it
+        Registering jobs and reading results can touch the disk (result store), so they run in
+        the default executor; logging only queues the record (app.logging)
+        """
+        loop = asyncio.get_running_loop()
+        path = scope['path']
+        args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'),
+                                   keep_blank_values=True))
+        if scope['method'] == 'POST' and path.startswith('/api/') and \
+                path[len('/api/'):] in BATCH_ENDPOINTS and not is_inline(args):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                # flask answers with its usual error
+                return False
+            request_type = path[len('/api/'):]
+            logger.info("Got %s_request with data: %s", request_type, Payload(data))
+            response = await loop.run_in_executor(None, register_job, data, request_type)
+            await send_json(send, response, *get_http_status(response))
+            return True
+
+        if scope['method'] == 'GET' and path.startswith('/api/get_results/'):
+            start = time.monotonic()
+            job_id = path[len('/api/get_results/'):]
+            logger.info("Get result for job_id %s", job_id)
+            if not webserver.tasks_runner.check_valid_job_id(job_id):
+                logger.info("Status error - invalid job_id")
+                observe_get_results(start)
+                await send_json(send, {'status': 'error', 'reason' : 'Invalid job_id'})
+                return True
+            wait = get_wait_time(args)
+            if wait > 0:
+                logger.info("Waiting at most %s seconds for job_id %s", wait, job_id)
+                await self.notifier.wait_job(job_id, wait)
+            response = await loop.run_in_executor(None, get_job_result, job_id,
+                                                  is_timing(args))
+            observe_get_results(start)
+            await send_json(send, response)
+            return True
+
+        if scope['method'] == 'GET' and path == '/api/events':
+            await self.stream_events(args, send)
+            return True
+        return False
+
+    async def stream_events(self, args, send):
+        """ /api/events on the event loop (see routes.job_events) """
+        loop = asyncio.get_running_loop()
+        stream = JobEventStream(args)
+        finished_jobs = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        # added before looking at current status => no event is missed
+        self.notifier.streams.add(finished_jobs)
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                    (b'cache-control', b'no-cache')]})
+            for event in await loop.run_in_executor(None, stream.start):
+                await send_event(send, event)
+            while stream.is_open():
+                if finished_jobs.empty() and finished_jobs not in self.notifier.streams:
+                    # client too slow, dropped => stream ends, the client reconnects
+                    break
+                try:
+                    job_id, status = await asyncio.wait_for(finished_jobs.get(),
+                                                            KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await send_event(send, KEEPALIVE_EVENT)
+                    continue
+                if stream.report(job_id):
+                    await send_event(send, await loop.run_in_executor(
+                        None, stream.format_event, job_id, status))
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            self.notifier.streams.discard(finished_jobs)
+
+
+# run with any ASGI server, e.g. uvicorn app.asgi:application
+application = AsgiApp(webserver)
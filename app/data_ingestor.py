@@ -1,27 +1,239 @@
 """ data_ingestor.py """
+import copy
 import csv
+import io
+import mmap
+import os
+import time
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from app.snapshot import get_source_key, read_snapshot, write_snapshot
+
+# columns kept as integer codes: name used by the app -> name of the csv column
+# (the first four are indexed and aggregated, all of them can be used by /api/query)
+CODED_COLUMNS = {"Question" : "Question",
+                 "Location" : "LocationDesc",
+                 "Stratification_Category" : "StratificationCategory1",
+                 "Stratification" : "Stratification1",
+                 "YearStart" : "YearStart",
+                 "YearEnd" : "YearEnd",
+                 "Class" : "Class",
+                 "Topic" : "Topic",
+                 "Total" : "Total",
+                 "Age (years)" : "Age(years)",
+                 "Education" : "Education",
+                 "Gender" : "Gender",
+                 "Income" : "Income",
+                 "Race/Ethnicity" : "Race/Ethnicity"}
+
+# columns that rows are grouped by, for each precomputed (sum, count) aggregate
+INDEX_COLUMNS = {"question" : ["Question"],
+                 "question_location" : ["Question", "Location"],
+                 "category" : ["Question", "Location", "Stratification_Category", "Stratification"]}
+
+# smallest part of a csv file worth parsing in another process
+MIN_PART_BYTES = 1 << 22
+
+def split_byte_ranges(csv_path, data_start, num_parts):
+    """
+    split rows of csv file (from byte data_start) into at most num_parts byte ranges
+    ranges start at the beginning of a line outside quotes (even number of '"' before it),
+    so a quoted field that contains a newline is never cut
+    """
+    size = os.path.getsize(csv_path)
+    num_parts = min(num_parts, (size - data_start) // MIN_PART_BYTES)
+    if num_parts <= 1:
+        return [(data_start, size)]
+    starts = [data_start]
+    with open(csv_path, mode = 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+        scanned = data_start
+        quotes = 0
+        for i in range(1, num_parts):
+            position = max(data_start + (size - data_start) * i // num_parts, scanned)
+            while position < size:
+                newline = contents.find(b'\n', position)
+                position = size if newline == -1 else newline + 1
+                quotes += contents[scanned:position].count(b'"')
+                scanned = position
+                if quotes % 2 == 0:
+                    break
+            if position < size:
+                starts.append(position)
+    return list(zip(starts, starts[1:] + [size]))
+
+def get_positions(header_line):
+    """
+    position of every needed column in the header line of a csv file, parsing only looks at
+    these (last column with that name, like csv.DictReader); ValueError if one is missing
+    """
+    header = next(csv.reader(io.StringIO(header_line)), [])
+    return {name : len(header) - 1 - header[::-1].index(name)
+            for name in ["Data_Value", *CODED_COLUMNS.values()]}
+
+def parse_byte_range(csv_path, first, last, positions):
+    """ parse rows between bytes first and last of csv file (see parse_rows) """
+    with open(csv_path, mode = 'rb') as f:
+        f.seek(first)
+        return parse_rows(io.BytesIO(f.read(last - first)), positions)
+
+def parse_text(text, positions):
+    """ parse csv rows (without header) of text (see parse_rows) """
+    return parse_rows(io.StringIO(text), positions)
+
+def parse_rows(source, positions):
+    """
+    parse csv rows (without header) of source (file object) with pandas' C parser, only the
+    needed columns are converted: Data_Value as strings, the other ones as categoricals
+    return (Data_Value as float64 array,
+            {csv column -> (distinct strings in order of first appearance, int32 codes)})
+    """
+    value_position = positions["Data_Value"]
+    dtypes = {position : 'category' for position in positions.values()}
+    dtypes[value_position] = str
+    try:
+        # strings as they are (no NaN for empty fields), empty lines are skipped like
+        # csv.DictReader does; columns of the frame are the positions in the header
+        frame = pd.read_csv(source, header=None, usecols=sorted(dtypes), dtype=dtypes,
+                            keep_default_na=False, encoding='utf-8')
+    except pd.errors.EmptyDataError:
+        # no rows
+        frame = pd.DataFrame({position : pd.Series(dtype=dtype)
+                              for position, dtype in dtypes.items()})
+    values = get_values(frame[value_position].to_numpy(dtype=object))
+    part_codes = {csv_column : get_first_appearance_codes(frame[positions[csv_column]])
+                  for csv_column in CODED_COLUMNS.values()}
+    return values, part_codes
+
+def get_values(texts):
+    """
+    float64 array of Data_Value strings, float() of each one, exactly as it was parsed before
+    a value that is not a number (e.g. empty) is NaN => ingestion goes on, only the jobs that
+    read it fail (see TaskSolver.get_mean_helper), as when values were converted at query time
+    """
+    try:
+        return texts.astype(np.float64)
+    except ValueError:
+        return np.array([parse_value(text) for text in texts], dtype=np.float64)
+
+def parse_value(text):
+    """ float() of text, NaN if it is not a number """
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+def get_first_appearance_codes(column):
+    """
+    (distinct strings in order of first appearance, int32 codes) of a categorical column
+    (its categories are sorted => renumbered, so vocabularies keep the order of the file)
+    """
+    codes = column.cat.codes.to_numpy()
+    present, first_rows = np.unique(codes, return_index=True)
+    order = present[np.argsort(first_rows)]
+    new_codes = np.empty(len(column.cat.categories), dtype=np.int32)
+    new_codes[order] = np.arange(len(order), dtype=np.int32)
+    # same newlines as a file opened in text mode (quoted fields can contain newlines)
+    words = [word.replace('\r\n', '\n').replace('\r', '\n')
+             for word in column.cat.categories[order]]
+    return words, new_codes[codes]
+
+def append_csv_file(csv_path, text):
+    """
+    append rows of csv text (header line first) to the csv file, in the order of its columns
+    (columns the text doesn't have are left empty) => a reload or a restart reads them again
+    """
+    with open(csv_path, mode = 'rb') as f:
+        header_line = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - 1, 0))
+        last_byte = f.read(1)
+    header = next(csv.reader(io.StringIO(header_line.decode('utf-8'))), [])
+    rows = io.StringIO()
+    if last_byte not in (b'', b'\n'):
+        # last row of the file didn't end its line
+        rows.write('\n')
+    writer = csv.writer(rows, lineterminator='\r\n' if header_line.endswith(b'\r\n') else '\n')
+    for row in csv.DictReader(io.StringIO(text), restval=''):
+        writer.writerow([row.get(name, '') for name in header])
+    with open(csv_path, mode = 'ab') as f:
+        f.write(rows.getvalue().encode('utf-8'))
+
+def get_chunk_rows(chunk):
+    """ number of rows of a chunk ({column -> array}) """
+    return len(chunk["Data_Value"])
+
+def merge_chunks(chunks):
+    """
+    chunks after a new one was added at the end: the last two are joined while the one before
+    is not larger => O(log rows) chunks, and over all appends a row is copied O(log rows)
+    times, not at every append (chunks that are not joined are shared with older versions)
+    """
+    chunks = list(chunks)
+    while len(chunks) > 1 and get_chunk_rows(chunks[-2]) <= get_chunk_rows(chunks[-1]):
+        last = chunks.pop()
+        chunks[-1] = {column : np.concatenate([chunks[-1][column], values])
+                      for column, values in last.items()}
+    return chunks
+
+def group_row_ids(code_columns):
+    """
+    group row ids by the given code columns (arrays of the same length)
+    return dictionary: tuple of codes -> row ids (ascending, so values keep row order)
+    """
+    if len(code_columns[0]) == 0:
+        return {}
+    keys = np.stack(code_columns, axis=1)
+    # lexsort is stable => row ids stay ascending inside each group
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)) + 1
+    return split_groups(sorted_keys[np.r_[0, starts]], order, starts)
+
+def split_groups(keys, rows, starts):
+    """
+    dictionary: tuple of codes -> row ids, from row ids of all groups one after another
+    (keys[i] - codes of group i, starts - where groups 1, 2, ... begin in rows)
+    row ids of each group are views into rows, not copies
+    """
+    return {tuple(int(code) for code in key) : group_rows
+            for key, group_rows in zip(keys, np.split(rows, starts))}
 
 class DataIngestor:
     """ DataIngestor class - edit data from csv file """
-    def __init__(self, csv_path: str):
-        """  Read data from csv file and store it in a list of dictionaries """
-        self.list_data = []
-        with open(csv_path, mode = 'r', encoding='utf-8') as f:
-            data = csv.DictReader(f)
-            for row in data:
-                # get only necessary data for tasks
-                dict_data_ingestor = {"Location" : row['LocationDesc'],
-                        "Question" : row['Question'],
-                        "Data_Value" : row['Data_Value'],
-                        "Stratification" : row['Stratification1'],
-                        "Stratification_Category" : row['StratificationCategory1'],
-                        "Total" : row['Total'],
-                        "Age (years)" : row['Age(years)'],
-                        "Education" : row['Education'], 
-                        "Gender" : row['Gender'],
-                        "Income" : row['Income'],
-                        "Race/Ethnicity" : row['Race/Ethnicity']}
-                self.list_data.append(dict_data_ingestor)
+    def __init__(self, csv_path=None, num_workers=None, snapshot_path=None, executor=None):
+        """
+        Read data from csv file and store it column by column:
+        Data_Value as a float64 array, the other needed columns as integer codes
+        into a vocabulary (list of distinct strings, in order of first appearance);
+        appended rows are kept in more chunks of columns (see append_csv)
+        Large files are parsed in parallel by num_workers processes (default: TP_INGEST_WORKERS
+        or number of cpus), forked for this file or, with executor, the worker processes of a
+        ProcessExecutor (once threads are running, no process is forked). With snapshot_path,
+        columns are memory-mapped from a binary snapshot of the csv file, written
+        after the first parse and rebuilt when the csv file changes => processes that use the
+        same snapshot share one copy of the data
+        Without csv file, data is empty until set_columns() is called
+        """
+        self.vocabularies = {column : [] for column in CODED_COLUMNS}
+        self.vocabulary_codes = {column : {} for column in CODED_COLUMNS}
+        # changes whenever the data changes (cached results of older versions are dropped)
+        self.version = 1
+        # rows, seconds, number of processes used to read the data and where it was read from
+        self.ingest_stats = {'rows' : 0, 'seconds' : 0.0, 'workers' : 0, 'source' : None}
+        # (path, key) of the snapshot the data is mapped from, None if data is in private memory
+        self.snapshot = None
+        if csv_path is None:
+            self.set_columns(np.empty(0, dtype=np.float64),
+                             {column : np.empty(0, dtype=np.int32) for column in CODED_COLUMNS})
+        else:
+            if num_workers is None:
+                num_workers = int(os.environ.get('TP_INGEST_WORKERS', os.cpu_count() or 1))
+            if snapshot_path is None:
+                self.read_csv(csv_path, num_workers, executor)
+            else:
+                self.load_snapshot(csv_path, num_workers, snapshot_path, executor)
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -45,3 +257,276 @@ class DataIngestor:
             'Percent of adults who engage in muscle-strengthening activities on' +
             '2 or more days a week',
         ]
+
+    def read_csv(self, csv_path, num_workers, executor=None):
+        """ parse csv file (in parallel, if it is large enough) and build columns from it """
+        start = time.perf_counter()
+        with open(csv_path, mode = 'rb') as f:
+            header_line = f.readline()
+        positions = get_positions(header_line.decode('utf-8'))
+        byte_ranges = split_byte_ranges(csv_path, len(header_line), num_workers)
+        arguments = [(csv_path, first, last, positions) for first, last in byte_ranges]
+        if len(byte_ranges) == 1:
+            parts = [parse_byte_range(*arguments[0])]
+        elif executor is not None:
+            parts = executor.parse_csv(parse_byte_range, arguments)
+        else:
+            # fork => workers don't import the app again
+            with get_context('fork').Pool(len(byte_ranges)) as pool:
+                parts = pool.starmap(parse_byte_range, arguments)
+
+        self.set_columns(*self.merge_parts(parts))
+        self.ingest_stats = {'rows' : self.num_rows,
+                             'seconds' : time.perf_counter() - start,
+                             'workers' : len(byte_ranges), 'source' : 'csv'}
+
+    def load_snapshot(self, csv_path, num_workers, snapshot_path, executor=None):
+        """
+        map snapshot of csv file if it was written from the current contents of the file,
+        otherwise parse csv file, write a new snapshot and map it
+        """
+        start = time.perf_counter()
+        key = get_source_key(csv_path)
+        if self.map_snapshot(snapshot_path, key):
+            self.ingest_stats = {'rows' : self.num_rows,
+                                 'seconds' : time.perf_counter() - start,
+                                 'workers' : 0, 'source' : 'snapshot'}
+            return
+        self.read_csv(csv_path, num_workers, executor)
+        try:
+            self.save_snapshot(snapshot_path, key)
+        except OSError:
+            # no snapshot => data stays in private memory, next start parses the csv file again
+            return
+        # use the mapped copy, so this process shares it with the others too
+        self.map_snapshot(snapshot_path, key)
+
+    def save_snapshot(self, snapshot_path, key):
+        """
+        write columns, vocabularies and (unless TP_SNAPSHOT_AGGREGATES=0) aggregates
+        to a snapshot identified by key (see snapshot.py)
+        """
+        arrays = {"Data_Value" : self.get_column("Data_Value")}
+        arrays.update({"codes/" + column : self.get_column(column) for column in CODED_COLUMNS})
+        objects = {"vocabularies" : self.vocabularies, "aggregates" : None}
+        if os.environ.get('TP_SNAPSHOT_AGGREGATES', '1') == '1':
+            objects["aggregates"] = self.aggregates
+        write_snapshot(snapshot_path, key, arrays, objects)
+
+    def map_snapshot(self, snapshot_path, key):
+        """ use data of snapshot identified by key, return False if there is no such snapshot """
+        snapshot = read_snapshot(snapshot_path, key)
+        if snapshot is None:
+            return False
+        arrays, objects = snapshot
+        self.set_vocabularies(objects["vocabularies"])
+        codes = {column : arrays["codes/" + column] for column in CODED_COLUMNS}
+        self.set_columns(arrays["Data_Value"], codes, objects["aggregates"])
+        self.snapshot = (snapshot_path, key)
+        return True
+
+    def merge_parts(self, parts):
+        """
+        join parts parsed by parse_byte_range: local codes of each part -> vocabulary codes
+        (parts are in file order => vocabularies keep the order of first appearance)
+        return (Data_Value column, {column -> codes})
+        """
+        codes = {}
+        for column, csv_column in CODED_COLUMNS.items():
+            translated = []
+            for _, part_codes in parts:
+                words, local_codes = part_codes[csv_column]
+                mapping = np.array([self.encode(column, word) for word in words], dtype=np.int32)
+                translated.append(mapping[local_codes] if words else local_codes)
+            codes[column] = np.concatenate(translated)
+        return np.concatenate([values for values, _ in parts]), codes
+
+    def append_csv(self, text):
+        """
+        new version of the data, with the rows of csv text (header line first) appended
+        the new rows are a new chunk (the last chunks are joined, see merge_chunks), the other
+        chunks are shared; only the aggregates that get new rows are copied and updated
+        => this version doesn't change and jobs still using it see consistent data
+        ingest_stats of the new version are about the appended rows
+        ValueError if a needed column is missing (values that are not numbers are NaN)
+        """
+        start = time.perf_counter()
+        header_line, _, rows_text = text.partition('\n')
+        part = parse_text(rows_text, get_positions(header_line.rstrip('\r')))
+        words = copy.copy(self)
+        # new words are added to copies of the vocabularies
+        words.set_vocabularies(self.vocabularies)
+        new_values, new_codes = words.merge_parts([part])
+        data = self.extend(merge_chunks(self.chunks + [dict(new_codes, Data_Value=new_values)]),
+                           words.vocabularies, self.version + 1)
+        # not the stats copied from this version
+        data.ingest_stats = {'rows' : len(new_values),
+                             'seconds' : time.perf_counter() - start,
+                             'workers' : 1, 'source' : 'append'}
+        return data
+
+    def extend(self, chunks, vocabularies, version):
+        """
+        new version of the data made of chunks: the rows of this version, then new rows
+        (vocabularies - start with the words of this version) => only the new rows are grouped
+        and added to the aggregates (see append_groups); this version doesn't change
+        """
+        data = copy.copy(self)
+        data.set_vocabularies(vocabularies)
+        data.chunks = chunks
+        data.num_rows = sum(get_chunk_rows(chunk) for chunk in chunks)
+        data.version = version
+        if chunks[0] is not self.chunks[0]:
+            # first rows were joined with others, they are not the ones mapped from a snapshot
+            data.snapshot = None
+        data.append_groups(data.get_column("Data_Value", self.num_rows),
+                           {column : data.get_column(column, self.num_rows)
+                            for column in CODED_COLUMNS})
+        return data
+
+    def append_groups(self, new_values, new_codes):
+        """
+        add rows (new_values, new_codes - their values and codes) after the others to the
+        aggregates; groups that change are copied, the others are shared with older versions
+        """
+        new_groups = {name : group_row_ids([new_codes[column] for column in columns])
+                      for name, columns in INDEX_COLUMNS.items()}
+        self.aggregates = {name : dict(aggregate) for name, aggregate in self.aggregates.items()}
+
+        for (q,), rows in new_groups["question"].items():
+            self.aggregates["question"][q] = self.add_values(
+                self.aggregates["question"].get(q, (0.0, 0)), new_values[rows])
+        # locations seen for the first time are added in order of first appearance
+        for key, rows in sorted(new_groups["question_location"].items(),
+                                key=lambda group: group[1][0]):
+            if key not in self.aggregates["question_location"]:
+                self.aggregates["locations"][key[0]] = \
+                    self.aggregates["locations"].get(key[0], []) + [key[1]]
+            self.aggregates["question_location"][key] = self.add_values(
+                self.aggregates["question_location"].get(key, (0.0, 0)), new_values[rows])
+        copied = set()
+        for (q, location, category, stratification), rows in new_groups["category"].items():
+            if (q, location) not in copied:
+                # categories of (q, location) are copied once, before the first change
+                copied.add((q, location))
+                self.aggregates["category"][(q, location)] = dict(
+                    self.aggregates["category"].get((q, location), {}))
+            category_aggregates = self.aggregates["category"][(q, location)]
+            pair = (category, stratification)
+            category_aggregates[pair] = self.add_values(
+                category_aggregates.get(pair, (0.0, 0)), new_values[rows])
+
+    def add_values(self, aggregate, values):
+        """
+        (sum, count) of a group after values are added to it - they are added one by one after
+        the old sum, exactly as sum_values would add them if it started from the first row
+        """
+        total, count = aggregate
+        if count == 0:
+            return self.sum_values(values), len(values)
+        return float(np.cumsum(np.r_[total, values])[-1]), count + len(values)
+
+    def set_columns(self, data_value, codes, aggregates=None):
+        """
+        use given columns (codes into current vocabularies), as one chunk, and build aggregates
+        on them; aggregates - already built for these columns, e.g. from a snapshot
+        """
+        # chunks of rows, one after another: {"Data_Value" -> values, column -> codes}
+        self.chunks = [dict(codes, Data_Value=data_value)]
+        self.num_rows = len(data_value)
+        # not the data of a snapshot anymore
+        self.snapshot = None
+        if aggregates is None:
+            # (sum, count) of each group => tasks are answered without touching rows; the row ids
+            # of the groups are only needed here (appends group the new rows only), not kept
+            aggregates = self.build_aggregates(data_value, {
+                name : group_row_ids([codes[column] for column in columns])
+                for name, columns in INDEX_COLUMNS.items()})
+        self.aggregates = aggregates
+
+    def get_column(self, column, first_row=0):
+        """
+        values of column ("Data_Value" or a coded column) from first_row on, joined from the
+        chunks (a copy only if they come from more than one chunk)
+        """
+        parts = []
+        start = 0
+        for chunk in self.chunks:
+            if start + get_chunk_rows(chunk) > first_row:
+                parts.append(chunk[column][max(first_row - start, 0):])
+            start += get_chunk_rows(chunk)
+        if not parts:
+            return self.chunks[-1][column][:0]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def set_vocabularies(self, vocabularies):
+        """ use given vocabularies (lists of strings, index = code) for coded columns """
+        self.vocabularies = {column : list(words) for column, words in vocabularies.items()}
+        self.vocabulary_codes = {column : {word : code for code, word in enumerate(words)}
+                                 for column, words in self.vocabularies.items()}
+
+    def encode(self, column, value):
+        """ get code of value in column's vocabulary (add value if it is new) """
+        codes = self.vocabulary_codes[column]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.vocabularies[column].append(value)
+        return codes[value]
+
+    def get_code(self, column, value):
+        """ get code of value in column's vocabulary, -1 if value was never seen """
+        return self.vocabulary_codes[column].get(value, -1)
+
+    def decode(self, column, code):
+        """ get string value for a code of column """
+        return self.vocabularies[column][code]
+
+    def sum_values(self, values):
+        """
+        sum values in row order, one by one (np.cumsum is sequential,
+        so results are rounded exactly as in a python loop, unlike np.sum)
+        """
+        if len(values) == 0:
+            return 0.0
+        return float(np.cumsum(values)[-1])
+
+    def build_aggregates(self, data_value, groups):
+        """
+        build (sum, count) for each group: per question, per (question, location)
+        and per (question, location, stratification category, stratification)
+        groups - {name in INDEX_COLUMNS -> (tuple of codes -> row ids in data_value)}
+        roll-ups are summed from rows, not from smaller groups, to keep the same rounding
+        """
+        aggregates = {"question" : {}, "question_location" : {}, "category" : {},
+                      "locations" : {}}
+        for (q,), rows in groups["question"].items():
+            aggregates["question"][q] = (self.sum_values(data_value[rows]), len(rows))
+        first_rows = {}
+        for key, rows in groups["question_location"].items():
+            aggregates["question_location"][key] = (self.sum_values(data_value[rows]),
+                                                    len(rows))
+            first_rows.setdefault(key[0], []).append((int(rows[0]), key[1]))
+        # locations of each question in order of first appearance
+        for q, locations in first_rows.items():
+            aggregates["locations"][q] = [location for _, location in sorted(locations)]
+        for (q, location, category, stratification), rows in groups["category"].items():
+            aggregates["category"].setdefault((q, location), {})[(category, stratification)] = \
+                (self.sum_values(data_value[rows]), len(rows))
+        return aggregates
+
+    def get_aggregate(self, q, state=None):
+        """ (sum, count) of values for question q (only for given state, if there is one) """
+        q_code = self.get_code("Question", q)
+        if state is None:
+            return self.aggregates["question"].get(q_code, (0.0, 0))
+        return self.aggregates["question_location"].get(
+            (q_code, self.get_code("Location", state)), (0.0, 0))
+
+    def get_locations(self, q):
+        """ location codes that answered question q, in order of first appearance """
+        return self.aggregates["locations"].get(self.get_code("Question", q), [])
+
+    def get_category_aggregates(self, q, state):
+        """ (sum, count) of each (stratification category, stratification) code pair """
+        return self.aggregates["category"].get(
+            (self.get_code("Question", q), self.get_code("Location", state)), {})
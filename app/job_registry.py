@@ -0,0 +1,164 @@
+""" job_registry.py """
+import os
+from queue import Queue, Full
+from threading import Lock, Event
+
+# events waiting to be read by one subscriber; a subscriber that falls further behind is dropped
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('TP_EVENTS_QUEUE_SIZE', 1000))
+
+class Subscriber:
+    """
+    Subscriber class - bounded queue of (job_id, status) of finished jobs
+    A subscriber whose queue is full is closed: it gets no more events and, once it read the
+    events already queued, get returns None (an event stream ends, its client reconnects)
+    """
+    def __init__(self, maxsize):
+        """ default constructor (maxsize - queued events, 0 = unbounded) """
+        self.events = Queue(maxsize)
+        self.closed = False
+
+    def put(self, event):
+        """ add event - return False (subscriber is closed) if the queue is full """
+        try:
+            self.events.put_nowait(event)
+        except Full:
+            self.closed = True
+            return False
+        return True
+
+    def get(self, timeout=None):
+        """
+        get oldest event (Empty if none arrives in timeout seconds)
+        None if the subscriber was closed and all its events were read
+        """
+        # closed only when the queue is full => a get that blocks is never missing the close
+        if self.closed and self.events.empty():
+            return None
+        return self.events.get(timeout=timeout)
+
+class JobRegistry:
+    """
+    JobRegistry class - status of every job, in a dictionary (constant time lookups)
+    Allocates job ids atomically and keeps live counters of running/done/failed jobs
+    """
+    def __init__(self):
+        """ default constructor """
+        self.lock = Lock()
+        self.job_counter = 0
+        # job_id -> 'running' / 'done' / 'failed'
+        self.jobs = {}
+        # job_id -> reason, for failed jobs
+        self.reasons = {}
+        # job_id -> timestamps of the job and worker that ran it, for jobs run by a worker
+        self.timings = {}
+        self.counts = {'running' : 0, 'done' : 0, 'failed' : 0}
+        # job_id -> event set when the job stops running (only for jobs someone waits for)
+        self.waiters = {}
+        # queues of subscribers to (job_id, status) events of finished jobs
+        self.subscribers = []
+        # subscribers closed because they didn't read their events fast enough
+        self.dropped_subscribers = 0
+
+    def new_job(self):
+        """ allocate a new job_id (marked as running) """
+        with self.lock:
+            self.job_counter += 1
+            job_id = 'job_id_' + str(self.job_counter)
+            self.jobs[job_id] = 'running'
+            self.counts['running'] += 1
+        return job_id
+
+    def set_status(self, job_id, status, reason=None, timing=None):
+        """
+        change status of job_id (reason - why the job failed, timing - timestamps of the job)
+        """
+        with self.lock:
+            self.counts[self.jobs[job_id]] -= 1
+            self.jobs[job_id] = status
+            self.counts[status] += 1
+            if reason is not None:
+                self.reasons[job_id] = reason
+            if timing is not None:
+                self.timings[job_id] = timing
+            waiter = None
+            subscribers = []
+            if status != 'running':
+                waiter = self.waiters.pop(job_id, None)
+                subscribers = list(self.subscribers)
+        if waiter is not None:
+            # wake up requests waiting for this job
+            waiter.set()
+        for subscriber in subscribers:
+            if not subscriber.put((job_id, status)):
+                # slow subscriber => dropped instead of buffering events without limit
+                self.drop_subscriber(subscriber)
+
+    def get_status(self, job_id):
+        """ get status of job_id (None if job_id is not valid) """
+        return self.jobs.get(job_id)
+
+    def wait_job(self, job_id, timeout):
+        """
+        block until job_id is not running anymore or timeout (seconds) expires
+        return status of job_id
+        """
+        with self.lock:
+            if self.jobs[job_id] != 'running':
+                return self.jobs[job_id]
+            waiter = self.waiters.setdefault(job_id, Event())
+        # woken up by set_status, no polling
+        waiter.wait(timeout)
+        return self.jobs[job_id]
+
+    def subscribe(self, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        """
+        get a Subscriber that receives (job_id, status) for every job that finishes from now on
+        (at most maxsize events waiting, 0 = unbounded)
+        """
+        subscriber = Subscriber(maxsize)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """ stop sending events to subscriber (if it was not dropped already) """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def drop_subscriber(self, subscriber=None):
+        """
+        stop sending events to a subscriber that fell behind and count it
+        (None - a subscriber that is not registered here, e.g. an event stream of the ASGI app)
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            self.dropped_subscribers += 1
+
+    def get_dropped_subscribers(self):
+        """ get number of subscribers dropped because they fell behind """
+        with self.lock:
+            return self.dropped_subscribers
+
+    def get_reason(self, job_id):
+        """ get reason why job_id failed """
+        return self.reasons.get(job_id)
+
+    def get_timing(self, job_id):
+        """ get timestamps of job_id and worker that ran it (None if no worker ran it) """
+        return self.timings.get(job_id)
+
+    def is_valid(self, job_id):
+        """ check if job_id was allocated """
+        return job_id in self.jobs
+
+    def get_counts(self):
+        """ get number of running, done and failed jobs """
+        with self.lock:
+            return dict(self.counts)
+
+    def get_jobs(self):
+        """ get status of all jobs, as a list of {job_id : status} """
+        with self.lock:
+            return [{job_id : status} for job_id, status in self.jobs.items()]
@@ -1,13 +1,129 @@
 """ logging.py """
+import atexit
+import os
+import random
+import reprlib
 import time
 import logging
-from logging.handlers import RotatingFileHandler
+from collections import deque
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import Full
+from threading import Event
+
+# characters of a logged payload (request data, results, job lists)
+PAYLOAD_MAX_CHARS = int(os.environ.get('TP_LOG_PAYLOAD_MAX', 200))
+# fraction of the messages with a payload that are logged (1 = all of them)
+PAYLOAD_SAMPLE_RATE = float(os.environ.get('TP_LOG_SAMPLE_RATE', 1))
+# records waiting to be written; when the queue is full new records are dropped
+LOG_QUEUE_SIZE = int(os.environ.get('TP_LOG_QUEUE_SIZE', 10000))
+# seconds the writer thread waits after the first record, to write records in batches
+LOG_FLUSH_INTERVAL = float(os.environ.get('TP_LOG_FLUSH_INTERVAL', 0.05))
+# records written between two points where the writer lets other threads run
+RECORDS_PER_YIELD = 16
+# file the log is written to (rotated files get .1, .2, ... appended)
+LOG_FILE = os.environ.get('TP_LOG_FILE', 'app/webserver.log')
+
+# repr that stops after a few items / characters => cost doesn't grow with the payload
+payload_repr = reprlib.Repr()
+payload_repr.maxlevel = 3
+payload_repr.maxdict = payload_repr.maxlist = payload_repr.maxset = 10
+payload_repr.maxstring = payload_repr.maxother = PAYLOAD_MAX_CHARS
+
+
+class Payload:
+    """
+    Payload class - logged value (request data, result, ...), formatted only if the message
+    is logged, with at most PAYLOAD_MAX_CHARS characters
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        """ default constructor """
+        self.value = value
+
+    def __str__(self):
+        """ truncated text of value """
+        text = payload_repr.repr(self.value)
+        if len(text) > PAYLOAD_MAX_CHARS:
+            text = text[:PAYLOAD_MAX_CHARS] + '...'
+        return text
+
+
+class BatchQueue:
+    """
+    BatchQueue class - queue of log records between request threads and the writer thread
+    Adding a record doesn't wake up the writer if it was already woken up: the writer waits
+    LOG_FLUSH_INTERVAL seconds after the first record, then writes everything queued until then
+    => at most one thread switch per batch, instead of one per record
+    """
+    def __init__(self, maxsize):
+        """ default constructor """
+        self.maxsize = maxsize
+        # deque append / popleft are atomic, no lock needed
+        self.records = deque()
+        self.ready = Event()
+        self.num_taken = 0
+
+    def put_nowait(self, record):
+        """ add record (Full if there are already maxsize records) """
+        if len(self.records) >= self.maxsize:
+            raise Full
+        self.records.append(record)
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def get(self, block=True):  # pylint: disable=unused-argument
+        """ take oldest record, wait for a batch if there is none (writer thread) """
+        while not self.records:
+            self.ready.wait()
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.ready.clear()
+        # let request threads waiting for the GIL run every few records => a batch doesn't
+        # delay a request for longer than writing RECORDS_PER_YIELD records
+        self.num_taken += 1
+        if self.num_taken % RECORDS_PER_YIELD == 0:
+            time.sleep(0)
+        return self.records.popleft()
+
+
+class PayloadSampler(logging.Filter):
+    """ PayloadSampler class - keep only PAYLOAD_SAMPLE_RATE of the messages with a payload """
+    def filter(self, record):
+        """ check if record is logged """
+        if PAYLOAD_SAMPLE_RATE >= 1 or not isinstance(record.args, tuple) or \
+                not any(isinstance(arg, Payload) for arg in record.args):
+            return True
+        return random.random() < PAYLOAD_SAMPLE_RATE
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    DroppingQueueHandler class - hand records to the background thread that writes them;
+    drops records instead of blocking the request thread when the queue is full
+    """
+    def __init__(self, log_queue):
+        """ default constructor """
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """ add record to queue, drop it if the queue is full """
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+# records go only through the queue below; otherwise handlers of parent loggers (flask adds one
+# to the 'app' logger) would format and write them in the request thread
+logger.propagate = False
+# TP_LOG=0 disables logging
+logger.disabled = os.environ.get('TP_LOG', '1') == '0'
 
-# create a file handler
-handler = RotatingFileHandler("app/webserver.log", maxBytes=1024 * 1024, backupCount=10)
+# create a file handler, used only by the background thread
+handler = RotatingFileHandler(LOG_FILE, maxBytes=1024 * 1024, backupCount=10)
 
 # create a logging format
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -15,5 +131,22 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 formatter.converter = time.gmtime
 
 handler.setFormatter(formatter)
+
+# request threads only merge the message with its (truncated) arguments and queue the record;
+# timestamps, formatting and disk I/O (with rotation) happen in the listener thread, in batches
+queue_handler = DroppingQueueHandler(BatchQueue(LOG_QUEUE_SIZE))
+queue_handler.addFilter(PayloadSampler())
+listener = QueueListener(queue_handler.queue, handler)
+
+def start_writer():
+    """
+    start the thread that writes the log - called by app/__init__ once the worker and parser
+    processes are forked (no process is forked while threads are running); records logged
+    before wait in the queue
+    """
+    listener.start()
+    # write queued records before the process ends
+    atexit.register(listener.stop)
+
 # add handler to logger
-logger.addHandler(handler)
+logger.addHandler(queue_handler)
@@ -0,0 +1,154 @@
+""" metrics.py """
+import bisect
+from threading import Lock
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# metric name -> (type, help)
+METRICS_HELP = {
+    'asc_requests_total' : ('counter', 'Job submissions by request type and outcome'),
+    'asc_jobs_total' : ('counter', 'Finished jobs by request type and status'),
+    'asc_queue_wait_seconds' : ('histogram', 'Time tasks spent in the tasks queue'),
+    'asc_solve_seconds' : ('histogram', 'Time spent solving tasks'),
+    'asc_result_write_seconds' : ('histogram', 'Time spent storing one result'),
+    'asc_get_results_seconds' : ('histogram', 'Latency of get_results requests'),
+    'asc_rejected_total' : ('counter', 'Jobs rejected because the queue was too long'),
+    'asc_queue_depth' : ('gauge', 'Jobs waiting in the tasks queue (a batch counts its queries)'),
+    'asc_workers_busy' : ('gauge', 'Worker threads solving a task'),
+    'asc_workers_idle' : ('gauge', 'Worker threads waiting for a task'),
+    'asc_jobs' : ('gauge', 'Jobs by current status'),
+    'asc_ingest_seconds' : ('gauge', 'Time spent reading the current version of the data '
+                                     '(or appending its rows to the previous one)'),
+    'asc_data_rows' : ('gauge', 'Rows of the current version of the data'),
+    'asc_data_version' : ('gauge', 'Current version of the data'),
+    'asc_log_dropped_total' : ('counter', 'Log records dropped because the log queue was full'),
+    'asc_events_dropped_subscribers_total' : ('counter', 'Event stream subscribers dropped '
+                                                         'because they fell behind'),
+}
+
+def format_labels(labels):
+    """ prometheus text of labels (tuple of (name, value) pairs) """
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+    """ prometheus text of a number """
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ Counter class - number changed under its own lock """
+    def __init__(self):
+        """ default constructor """
+        self.lock = Lock()
+        self.value = 0
+
+    def add(self, value):
+        """ add value (negative for gauges that go down) """
+        with self.lock:
+            self.value += value
+
+
+class Histogram:
+    """ Histogram class - number of observed values in each bucket, their count and sum """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """ default constructor """
+        self.buckets = buckets
+        self.lock = Lock()
+        # last one counts values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ add one observed value """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def get_values(self):
+        """ get (cumulative counts of the buckets, count, sum) """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        count = 0
+        for bucket_count in counts:
+            count += bucket_count
+            cumulative.append(count)
+        return cumulative, count, total
+
+    def get_samples(self, name, labels):
+        """ samples (name, labels, value) of the histogram: buckets, count and sum """
+        cumulative, count, total = self.get_values()
+        samples = [(name + '_bucket', labels + (('le', format_value(bound)),), bucket_count)
+                   for bound, bucket_count in zip(self.buckets + (float('inf'),), cumulative)]
+        samples.append((name + '_count', labels, count))
+        samples.append((name + '_sum', labels, total))
+        return samples
+
+
+class Metrics:
+    """
+    Metrics class - counters and histograms of the server, in Prometheus text format
+    Every series has its own lock, held only to add one value => threads updating different
+    series never wait for each other; the series dictionaries are locked only to add a series
+    """
+    def __init__(self):
+        """ default constructor """
+        self.lock = Lock()
+        # (name, labels) -> Counter / Histogram
+        self.counters = {}
+        self.histograms = {}
+
+    def get_series(self, series, key, create):
+        """ get series with given key, create it the first time """
+        value = series.get(key)
+        if value is None:
+            with self.lock:
+                value = series.setdefault(key, create())
+        return value
+
+    def add(self, name, labels=(), value=1):
+        """ add value to counter (or gauge) name with labels (tuple of (name, value) pairs) """
+        self.get_series(self.counters, (name, labels), Counter).add(value)
+
+    def observe(self, name, value, labels=()):
+        """ add observed value (seconds) to histogram name with labels """
+        self.get_series(self.histograms, (name, labels), Histogram).observe(value)
+
+    def get_value(self, name, labels=()):
+        """ current value of counter name with labels (0 if nothing was added) """
+        counter = self.counters.get((name, labels))
+        return 0 if counter is None else counter.value
+
+    def render(self, gauges=()):
+        """
+        all series as prometheus text, with gauges measured by the caller
+        gauges - list of (name, labels, value)
+        """
+        samples = {}
+        for (name, labels), counter in list(self.counters.items()):
+            samples.setdefault(name, []).append((name, labels, counter.value))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), histogram in list(self.histograms.items()):
+            samples.setdefault(name, []).extend(histogram.get_samples(name, labels))
+
+        text = []
+        for name in sorted(samples):
+            metric_type, metric_help = METRICS_HELP.get(name, ('untyped', name))
+            text.append(f'# HELP {name} {metric_help}')
+            text.append(f'# TYPE {name} {metric_type}')
+            for sample_name, labels, value in samples[name]:
+                text.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(text) + '\n'
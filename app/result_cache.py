@@ -0,0 +1,90 @@
+""" result_cache.py """
+import json
+from collections import OrderedDict
+from threading import Lock
+
+class ResultCache:
+    """
+    ResultCache class - LRU cache of task results, shared by all threads
+    Entries are keyed by (request_type, question, state - only for the state endpoints) and
+    limited both by number of entries and by size (bytes of the json result); the least
+    recently used ones are evicted
+    """
+    def __init__(self, max_entries, max_bytes):
+        """ default constructor """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # key -> (result, size in bytes), most recently used at the end
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        # version of the data the cached results were computed from
+        self.data_version = None
+        self.stats = {'hits' : 0, 'misses' : 0, 'evictions' : 0, 'invalidations' : 0}
+
+    def check_version(self, data_version):
+        """
+        drop all results if data_version is newer than the data they were computed from
+        return False if data_version is older (job still solved from an older version of the
+        data), its results are not cached and cached results are not used for it
+        """
+        if self.data_version is not None and data_version < self.data_version:
+            return False
+        if data_version != self.data_version:
+            if self.entries:
+                self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.num_bytes = 0
+            self.data_version = data_version
+        return True
+
+    def get(self, key, data_version):
+        """ get cached result for key (None if not cached) """
+        with self.lock:
+            if not self.check_version(data_version) or key not in self.entries:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            # mark as most recently used
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def contains(self, key, data_version):
+        """ check if key is cached (doesn't count as hit/miss, doesn't change LRU order) """
+        with self.lock:
+            return data_version == self.data_version and key in self.entries
+
+    def put(self, key, result, data_version):
+        """ add result to cache, evict least recently used results if limits are exceeded """
+        size = len(json.dumps(result))
+        if self.max_entries <= 0 or size > self.max_bytes:
+            # cache disabled or result too big to be cached
+            return
+        with self.lock:
+            if not self.check_version(data_version):
+                return
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.num_bytes += size
+            while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        """ drop all cached results """
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+            self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        """ get counters and current size of the cache """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.num_bytes
+            stats['max_entries'] = self.max_entries
+            stats['max_bytes'] = self.max_bytes
+        return stats
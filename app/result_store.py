@@ -0,0 +1,143 @@
+""" result_store.py """
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+def get_env_number(name, default):
+    """ get numeric value of environment variable (default if it is not defined) """
+    if name in os.environ:
+        return float(os.environ[name])
+    return default
+
+class FileResultStore:
+    """
+    FileResultStore class - results written to <directory>/<pid>/<job_id>.txt
+    Every server process counts job ids from 1 => each one has its own subdirectory (named after
+    its pid), processes that share directory never read or remove each other's results
+    Results older than ttl seconds are removed, so the directory doesn't grow forever
+    """
+    def __init__(self, directory, ttl):
+        """ default constructor """
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.ttl = ttl
+        self.lock = Lock()
+        # job_id -> time the result was stored, oldest first
+        self.files = OrderedDict()
+        self.stats = {'expired' : 0}
+        os.makedirs(self.directory, exist_ok=True)
+        # left by an earlier process with the same pid => stale, its job ids are reused
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.txt'):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def get_file_name(self, job_id):
+        """ get name of file for job_id """
+        return os.path.join(self.directory, job_id + '.txt')
+
+    def put(self, job_id, result_status):
+        """ store result of job_id """
+        with self.lock:
+            self.write_file(job_id, result_status, time.monotonic())
+            self.evict_expired()
+
+    def get(self, job_id):
+        """ get result of job_id (None if there is no result, or if it expired) """
+        with self.lock:
+            self.evict_expired()
+            return self.read_file(job_id)
+
+    def write_file(self, job_id, result_status, stored_at):
+        """ create file and write result to it as json """
+        with open(self.get_file_name(job_id), 'w', encoding='utf-8') as f:
+            json.dump(result_status, f)
+        self.files[job_id] = stored_at
+
+    def read_file(self, job_id):
+        """ read result from file (None if there is no file for job_id) """
+        if job_id not in self.files:
+            return None
+        with open(self.get_file_name(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def evict_expired(self):
+        """ remove files older than ttl """
+        expire_before = time.monotonic() - self.ttl
+        while self.files and next(iter(self.files.values())) < expire_before:
+            job_id, _ = self.files.popitem(last=False)
+            os.remove(self.get_file_name(job_id))
+            self.stats['expired'] += 1
+
+    def get_stats(self):
+        """ get number of stored and expired results """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['on_disk'] = len(self.files)
+        return stats
+
+
+class MemoryResultStore(FileResultStore):
+    """
+    MemoryResultStore class - results kept in memory, no file access when they are polled
+    Above max_entries the oldest results are spilled to disk (if spill is set) or dropped;
+    results older than ttl seconds are removed from memory and from disk
+    """
+    def __init__(self, directory, ttl, max_entries, spill):
+        """ default constructor """
+        super().__init__(directory, ttl)
+        self.max_entries = max_entries
+        self.spill = spill
+        # job_id -> (time the result was stored, result), oldest first
+        self.results = OrderedDict()
+        self.stats.update({'spilled' : 0, 'dropped' : 0})
+
+    def put(self, job_id, result_status):
+        """ store result of job_id in memory, spill oldest results if memory is full """
+        with self.lock:
+            self.results[job_id] = (time.monotonic(), result_status)
+            while len(self.results) > self.max_entries:
+                old_job_id, (stored_at, old_result) = self.results.popitem(last=False)
+                if self.spill:
+                    self.write_file(old_job_id, old_result, stored_at)
+                    self.stats['spilled'] += 1
+                else:
+                    self.stats['dropped'] += 1
+            self.evict_expired()
+
+    def get(self, job_id):
+        """ get result of job_id from memory or from disk """
+        with self.lock:
+            self.evict_expired()
+            if job_id in self.results:
+                return self.results[job_id][1]
+            return self.read_file(job_id)
+
+    def evict_expired(self):
+        """ remove results older than ttl (from memory and from disk) """
+        expire_before = time.monotonic() - self.ttl
+        while self.results and next(iter(self.results.values()))[0] < expire_before:
+            self.results.popitem(last=False)
+            self.stats['expired'] += 1
+        super().evict_expired()
+
+    def get_stats(self):
+        """ get number of results in memory, on disk, spilled, dropped and expired """
+        stats = super().get_stats()
+        with self.lock:
+            stats['in_memory'] = len(self.results)
+        return stats
+
+
+def create_result_store():
+    """
+    create result store configured by environment variables:
+    TP_RESULT_STORE (memory/file), TP_RESULT_DIR, TP_RESULT_TTL (seconds),
+    TP_RESULT_MAX_ENTRIES (results kept in memory), TP_RESULT_SPILL (1/0)
+    """
+    directory = os.environ.get('TP_RESULT_DIR', 'results')
+    ttl = get_env_number('TP_RESULT_TTL', 3600)
+    if os.environ.get('TP_RESULT_STORE', 'memory') == 'file':
+        return FileResultStore(directory, ttl)
+    return MemoryResultStore(directory, ttl, int(get_env_number('TP_RESULT_MAX_ENTRIES', 10000)),
+                             os.environ.get('TP_RESULT_SPILL', '1') == '1')
@@ -1,8 +1,11 @@
 """ routes.py """
 import json
-from flask import request, jsonify
+import time
+from queue import Empty
+from flask import request, jsonify, Response
 from app import webserver
-from app.logging import logger
+from app.logging import logger, queue_handler, Payload
+from app.task_runner import get_failure_reason
 
 @webserver.route('/api/post_endpoint', methods=['POST'])
 def post_endpoint():
@@ -23,30 +26,323 @@ def post_endpoint():
     return jsonify({"error": "Method not allowed"}), 405
 
 
+# endpoints that can be used in /api/batch
+BATCH_ENDPOINTS = ('states_mean', 'state_mean', 'best5', 'worst5', 'global_mean',
+                   'diff_from_mean', 'state_diff_from_mean', 'mean_by_category',
+                   'state_mean_by_category')
+
+def count_request(request_type, outcome):
+    """
+    count job submission (outcome: queued, inline, invalid, rejected or failed) for /metrics
+    """
+    webserver.tasks_runner.metrics.add('asc_requests_total', (('request_type', request_type),
+                                                              ('outcome', outcome)))
+
+
+def register_job(data, request_type, inline=False):
+    """
+    Register job with a new job_id and add task to queue to be processed by threads
+    (or solve it directly, if inline is set)
+    Return response (dictionary) with associated job_id
+    """
+    # shutdown event is set, no more tasks can be added
+    if webserver.tasks_runner.shutdown_event.is_set():
+        logger.info("Shutting down - request won't be processed")
+        return {'job_is' : -1, 'reason' : 'shutting down'}
+
+    # unknown question / state => rejected before it takes a job_id and a worker
+    reason = webserver.tasks_runner.task_solver.check_task(data, request_type)
+    if reason is not None:
+        logger.info("Status error - invalid %s request: %s", request_type, reason)
+        count_request(request_type, 'invalid')
+        return {'status': 'error', 'reason': reason}
+
+    # cached or cheap results are returned directly, they don't take a place in the queue
+    result_status = None
+    if inline:
+        result_status = webserver.tasks_runner.solve_inline(data, request_type,
+                                                            webserver.config['INLINE_MAX_COST'])
+
+    # queue too long => rejected, the client is told when to try again
+    if result_status is None:
+        reason = webserver.tasks_runner.check_capacity(request_type)
+        if reason is not None:
+            logger.info("Status error - %s request rejected: %s", request_type, reason)
+            count_request(request_type, 'rejected')
+            return {'status': 'error', 'reason': reason,
+                    'retry_after': webserver.tasks_runner.limiter.retry_after}
+
+    # unique job_id (allocated atomically, safe for concurrent requests)
+    job_id = webserver.tasks_runner.job_registry.new_job()
+    try:
+        return queue_job(data, request_type, job_id, result_status)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # job_id is already allocated => it fails (with the reason), it never stays running
+        reason = fail_new_jobs([job_id], request_type, e)
+        return {'job_id': job_id, 'status': 'failed', 'reason': reason}
+
+
+def queue_job(data, request_type, job_id, result_status=None):
+    """
+    add task of job_id to queue (or store its result, if it was solved inline)
+    Return response (dictionary) with job_id
+    """
+    if result_status is not None:
+        webserver.tasks_runner.finish_inline(job_id, result_status)
+        logger.info("Solved inline task with job_id: %s", job_id)
+        count_request(request_type, 'inline')
+        return {'job_id': job_id, **result_status}
+
+    logger.info("Adding task to queue with job_id: %s", job_id)
+    webserver.tasks_runner.add_task(data, request_type, job_id)
+    count_request(request_type, 'queued')
+
+    return {'job_id': job_id}
+
+
+def fail_new_jobs(job_ids, request_type, exception):
+    """
+    mark jobs that got a job_id but couldn't be queued (or solved inline) as failed
+    return reason of the failure
+    """
+    reason = get_failure_reason(exception)
+    logger.exception("Could not queue %s request with job_ids %s", request_type,
+                     Payload(job_ids))
+    for job_id in job_ids:
+        webserver.tasks_runner.job_registry.set_status(job_id, 'failed', reason)
+    count_request(request_type, 'failed')
+    return reason
+
+
+def is_inline(args):
+    """ check if inline mode is asked for (?inline=1, default TP_INLINE_RESULTS) """
+    return args.get('inline', webserver.config['INLINE_RESULTS']) == '1'
+
+
+def get_http_status(response):
+    """ HTTP status code and headers of a register_job response """
+    if 'retry_after' in response:
+        # 429 Too Many Requests
+        return 429, {'Retry-After': str(response['retry_after'])}
+    return 200, {}
+
+
+def submit_job(data, request_type):
+    """ Register job (see register_job), return associated job_id """
+    response = register_job(data, request_type, is_inline(request.args))
+    status, headers = get_http_status(response)
+    return jsonify(response), status, headers
+
+
+def get_job_timing(job_id):
+    """
+    timestamps (enqueued, started, solved, persisted) of job_id, worker (TaskRunner index) that
+    ran it and the time spent in each step - None if no worker ran it (e.g. solved inline)
+    """
+    timing = webserver.tasks_runner.job_registry.get_timing(job_id)
+    if timing is None:
+        return None
+    timing = dict(timing)
+    timing['queue_wait'] = timing['started'] - timing['enqueued']
+    timing['solve'] = timing['solved'] - timing['started']
+    if 'persisted' in timing:
+        timing['persist'] = timing['persisted'] - timing['solved']
+    return timing
+
+
+def get_job_result(job_id, with_timing=False):
+    """
+    Return response (dictionary) with status of job_id, and its result if it is done
+    with_timing - add timing block of the job (see get_job_timing), once it finished
+    """
+    job_registry = webserver.tasks_runner.job_registry
+    # check if task is done and return result if so
+    if job_registry.get_status(job_id) == 'done':
+        # Get the result from the result store (memory or disk)
+        res = webserver.tasks_runner.result_store.get(job_id)
+        if res is None:
+            logger.info("Status error - result expired")
+            return {'status': 'error', 'reason' : 'Result expired'}
+
+        logger.info("Result for %s is %s", job_id, Payload(res['data']))
+        response = {
+            'status': 'done',
+            'data': res['data'],
+            'data_version': res['data_version']
+        }
+    elif job_registry.get_status(job_id) == 'failed':
+        reason = job_registry.get_reason(job_id)
+        logger.info("Job %s failed: %s", job_id, reason)
+        response = {'status': 'failed', 'reason': reason}
+    else:
+        # If not, return running status
+        return {'status': 'running'}
+    if with_timing:
+        timing = get_job_timing(job_id)
+        if timing is not None:
+            response['timing'] = timing
+    return response
+
+
+def is_timing(args):
+    """ check if the timing block is asked for (?timing=1) """
+    return args.get('timing', '0') == '1'
+
+
+def get_wait_time(args):
+    """ how long (seconds) a get_results request waits for its job (?wait=, capped) """
+    wait = args.get('wait', default=0, type=float)
+    return min(wait, webserver.config['MAX_RESULT_WAIT'])
+
+
+def observe_get_results(start):
+    """ record latency of a get_results request that started at start (time.monotonic) """
+    webserver.tasks_runner.metrics.observe('asc_get_results_seconds', time.monotonic() - start)
+
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
-    """ /api/get_results/<job_id> """
+    """
+    /api/get_results/<job_id>
+    ?wait=<seconds> - wait for the job to finish, ?timing=1 - add timing block of the job
+    """
+    start = time.monotonic()
     logger.info("Get result for job_id %s", job_id)
     # Check if job_id is valid
     if webserver.tasks_runner.check_valid_job_id(job_id) is False:
         logger.info("Status error - invalid job_id")
+        observe_get_results(start)
         return jsonify({'status': 'error', 'reason' : 'Invalid job_id'})
 
-    # check if task is done and return result if so
-    index_res = int(job_id.split('_').pop()) - 1
-    if webserver.tasks_runner.tasks_state[index_res][job_id] == 'done':
-        # Read the result from disk
-        file_name = 'results/' + job_id + '.txt'
-        with open(file_name, 'r', encoding='utf-8') as f:
-            res = json.load(f)
-
-        logger.info("Result for %s is %s", job_id, str(res['data']))
-        return jsonify({
-            'status': 'done',
-            'data': res['data']
-        })
-    # If not, return running status
-    return jsonify({'status': 'running'})
+    # long poll: ?wait=<seconds> holds the request until the job is done or time expires
+    wait = get_wait_time(request.args)
+    if wait > 0:
+        logger.info("Waiting at most %s seconds for job_id %s", wait, job_id)
+        webserver.tasks_runner.job_registry.wait_job(job_id, wait)
+
+    response = get_job_result(job_id, is_timing(request.args))
+    observe_get_results(start)
+    return jsonify(response)
+
+
+def format_job_event(job_id, status, with_results):
+    """ format finished job as a server-sent event """
+    event = {'job_id': job_id, 'status': status}
+    if status == 'failed':
+        event['reason'] = webserver.tasks_runner.job_registry.get_reason(job_id)
+    elif with_results:
+        res = webserver.tasks_runner.result_store.get(job_id)
+        if res is not None:
+            event['data'] = res['data']
+            event['data_version'] = res['data_version']
+    return 'event: job\ndata: ' + json.dumps(event) + '\n\n'
+
+
+def start_job_events(job_ids, with_results):
+    """
+    events for jobs of job_ids that are already finished (or not valid)
+    return (events, job_ids still running - reported when they finish; None for all jobs)
+    """
+    if job_ids is None:
+        return [], None
+    events = []
+    pending = set()
+    for job_id in job_ids:
+        status = webserver.tasks_runner.job_registry.get_status(job_id)
+        if status is None:
+            events.append('event: job\ndata: ' + json.dumps(
+                {'job_id': job_id, 'status': 'error', 'reason': 'Invalid job_id'}) + '\n\n')
+        elif status == 'running':
+            pending.add(job_id)
+        else:
+            # job already finished
+            events.append(format_job_event(job_id, status, with_results))
+    return events, pending
+
+
+def get_event_job_ids(args):
+    """ job_ids an event stream is about (?job_ids=job_id_1,job_id_2), None for all jobs """
+    if args.get('job_ids'):
+        return set(args.get('job_ids').split(','))
+    return None
+
+
+# seconds between keep-alive comments of an event stream
+KEEPALIVE_INTERVAL = 15
+# sent when no job was reported for KEEPALIVE_INTERVAL seconds => connection stays open
+KEEPALIVE_EVENT = ': keepalive\n\n'
+
+
+class JobEventStream:
+    """
+    JobEventStream class - one /api/events stream: which finished jobs it reports, their events
+    and when it ends; the front ends (flask, asgi.py) only wait for finished jobs and send events
+    """
+    def __init__(self, args):
+        """ stream asked for by the query args (?job_ids=, ?results=) """
+        self.job_ids = get_event_job_ids(args)
+        self.with_results = args.get('results', '0') == '1'
+        # job_ids still running (known once started), None for all jobs
+        self.pending = None
+        logger.info("Got events request for job_ids: %s", Payload(self.job_ids))
+
+    def start(self):
+        """
+        events of the jobs that already finished (or are not valid)
+        called after subscribing to finished jobs => no event is missed
+        """
+        events, self.pending = start_job_events(self.job_ids, self.with_results)
+        return events
+
+    def is_open(self):
+        """ check if there are jobs left to report (a stream about all jobs never ends) """
+        return self.pending is None or bool(self.pending)
+
+    def report(self, job_id):
+        """ check if the stream reports finished job_id (then it is not pending anymore) """
+        if self.pending is None:
+            return True
+        if job_id not in self.pending:
+            return False
+        self.pending.discard(job_id)
+        return True
+
+    def format_event(self, job_id, status):
+        """ event of finished job_id (see format_job_event) """
+        return format_job_event(job_id, status, self.with_results)
+
+
+@webserver.route('/api/events', methods=['GET'])
+def job_events():
+    """
+    Stream (server-sent events) job_id and status of jobs, as soon as they finish
+    ?job_ids=job_id_1,job_id_2 - only these jobs, stream ends when all of them are reported
+    ?results=1 - add result of each job to its event
+    """
+    job_registry = webserver.tasks_runner.job_registry
+    stream = JobEventStream(request.args)
+    # subscribe before looking at current status => no event is missed
+    subscriber = job_registry.subscribe()
+
+    def generate():
+        try:
+            yield from stream.start()
+            while stream.is_open():
+                try:
+                    finished_job = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                except Empty:
+                    yield KEEPALIVE_EVENT
+                    continue
+                if finished_job is None:
+                    # client too slow, dropped => stream ends, the client reconnects
+                    break
+                if stream.report(finished_job[0]):
+                    yield stream.format_event(*finished_job)
+        finally:
+            job_registry.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @webserver.route('/api/states_mean', methods=['POST'])
@@ -54,26 +350,12 @@ def states_mean_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got states_mean_request with data: %s", str(data))
-    # shutdown event is set, no more tasks can be added
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    # get data from request and process it
-    request_type = 'states_mean'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    # add task to queue to be processed by threads
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got states_mean_request with data: %s", Payload(data))
+    return submit_job(data, 'states_mean')
 
 
 @webserver.route('/api/state_mean', methods=['POST'])
@@ -81,23 +363,12 @@ def state_mean_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got state_mean_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'state_mean'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got state_mean_request with data: %s", Payload(data))
+    return submit_job(data, 'state_mean')
 
 
 @webserver.route('/api/best5', methods=['POST'])
@@ -105,46 +376,24 @@ def best5_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got best5_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'best5'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got best5_request with data: %s", Payload(data))
+    return submit_job(data, 'best5')
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got worst5_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'worst5'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got worst5_request with data: %s", Payload(data))
+    return submit_job(data, 'worst5')
 
 
 @webserver.route('/api/global_mean', methods=['POST'])
@@ -152,23 +401,12 @@ def global_mean_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got global_mean_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'global_mean'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got global_mean_request with data: %s", Payload(data))
+    return submit_job(data, 'global_mean')
 
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
@@ -176,23 +414,12 @@ def diff_from_mean_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got diff_from_mean_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'diff_from_mean'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got diff_from_mean_request with data: %s", Payload(data))
+    return submit_job(data, 'diff_from_mean')
 
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
@@ -200,23 +427,12 @@ def state_diff_from_mean_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got state_diff_from_mean_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'state_diff_from_mean'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got state_diff_from_mean_request with data: %s", Payload(data))
+    return submit_job(data, 'state_diff_from_mean')
 
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
@@ -224,23 +440,12 @@ def mean_by_category_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
     Return associated job_id
     """
     data = request.json
-    logger.info("Got mean_by_category_request with data: %s", str(data))
-    if webserver.tasks_runner.shutdown_event.is_set():
-        logger.info("Shutting down - request won't be processed")
-        return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
-
-    request_type = 'mean_by_category'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    logger.info("Got mean_by_category_request with data: %s", Payload(data))
+    return submit_job(data, 'mean_by_category')
 
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
@@ -248,32 +453,92 @@ def state_mean_by_category_request():
     """
     Get request data
     Register job. Don't wait for task to finish
-    Increment job_id counter
+    Allocate new job_id
+    Return associated job_id
+    """
+    data = request.json
+    logger.info("Got state_mean_by_category_request with data: %s", Payload(data))
+    return submit_job(data, 'state_mean_by_category')
+
+@webserver.route('/api/query', methods=['POST'])
+def query_request():
+    """
+    Get query: {"filters": {column: value or [values]}, "group_by": [columns],
+    "aggregate": "mean" / "sum" / "count" / "min" / "max"}
+    Register job. Don't wait for task to finish
     Return associated job_id
     """
     data = request.json
-    logger.info("Got state_mean_by_category_request with data: %s", str(data))
+    logger.info("Got query_request with data: %s", Payload(data))
+    return submit_job(data, 'query')
+
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """
+    Get list of queries: {"queries": [{"endpoint": "best5", "question": ...}, ...]}
+    Register one job for each query, all solved together (queries about the same
+    question share their work). Don't wait for tasks to finish
+    Return associated job_ids, in the order of the queries
+    """
+    data = request.json
+    logger.info("Got batch_request with data: %s", Payload(data))
     if webserver.tasks_runner.shutdown_event.is_set():
         logger.info("Shutting down - request won't be processed")
         return jsonify({'job_is' : -1, 'reason' : 'shutting down'})
 
-    request_type = 'state_mean_by_category'
-    job_id = 'job_id_' + str(webserver.job_counter)
-    webserver.job_counter += 1
-
-    logger.info("Adding task to queue with job_id: %s", job_id)
-    webserver.tasks_runner.add_task(data, request_type, job_id)
-
-    return jsonify({'job_id': job_id})
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries or \
+            not all(isinstance(query, dict) and query.get('endpoint') in BATCH_ENDPOINTS
+                    for query in queries):
+        logger.info("Status error - invalid batch")
+        return jsonify({'status': 'error', 'reason': 'Invalid batch'})
+    # one task in the queue => its size is bounded
+    max_batch = webserver.tasks_runner.limiter.max_batch
+    if 0 < max_batch < len(queries):
+        logger.info("Status error - batch of %d queries", len(queries))
+        return jsonify({'status': 'error',
+                        'reason': f'Batch too large (at most {max_batch} queries)'})
+
+    tasks = []
+    task_solver = webserver.tasks_runner.task_solver
+    for i, query in enumerate(queries):
+        task = {key : value for key, value in query.items() if key != 'endpoint'}
+        reason = task_solver.check_task(task, query['endpoint'])
+        if reason is not None:
+            logger.info("Status error - invalid query %d of batch: %s", i, reason)
+            return jsonify({'status': 'error', 'reason': f'Invalid batch query {i}: {reason}'})
+        task['request_type'] = query['endpoint']
+        tasks.append(task)
+    # whole batch is one task in the queue, but it holds a job for each query
+    reason = webserver.tasks_runner.check_capacity('batch', len(tasks))
+    if reason is not None:
+        logger.info("Status error - batch rejected: %s", reason)
+        count_request('batch', 'rejected')
+        retry_after = webserver.tasks_runner.limiter.retry_after
+        return jsonify({'status': 'error', 'reason': reason, 'retry_after': retry_after}), \
+            429, {'Retry-After': str(retry_after)}
+    job_ids = [webserver.tasks_runner.job_registry.new_job() for _ in tasks]
+
+    logger.info("Adding batch to queue with job_ids: %s", Payload(job_ids))
+    try:
+        webserver.tasks_runner.add_batch(tasks, job_ids)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # every job of the batch fails, none of them stays running
+        reason = fail_new_jobs(job_ids, 'batch', e)
+        return jsonify({'job_ids': job_ids, 'status': 'failed', 'reason': reason})
+    count_request('batch', 'queued')
+
+    return jsonify({'job_ids': job_ids})
 
 @webserver.route('/api/jobs', methods=['GET'])
 def jobs_response():
     """
     Return status for all job_ids
     """
-    logger.info("Got jobs request - returning all jobs status: %s",
-                str(webserver.tasks_runner.tasks_state))
-    return jsonify({'status' : 'done', 'data' : webserver.tasks_runner.tasks_state})
+    jobs = webserver.tasks_runner.job_registry.get_jobs()
+    logger.info("Got jobs request - returning all jobs status: %s", Payload(jobs))
+    return jsonify({'status' : 'done', 'data' : jobs})
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def num_jobs_response():
@@ -281,14 +546,114 @@ def num_jobs_response():
     Return number of running tasks
     """
     logger.info("Got num_jobs request")
-    num_running = 0
-    for task in webserver.tasks_runner.tasks_state:
-        for _, value in task.items():
-            if value == 'running':
-                num_running += 1
+    # live counter, no need to look at every job
+    num_running = webserver.tasks_runner.job_registry.get_counts()['running']
     logger.info("Number of running jobs: %s", str(num_running))
     return jsonify({'jobs_running' : num_running})
 
+@webserver.route('/api/cache_stats', methods=['GET'])
+def cache_stats_response():
+    """
+    Return result cache counters (hits, misses, evictions) and size
+    """
+    logger.info("Got cache_stats request")
+    stats = webserver.tasks_runner.task_solver.cache.get_stats()
+    logger.info("Cache stats: %s", str(stats))
+    return jsonify({'status' : 'done', 'data' : stats})
+
+@webserver.route('/api/coalesce_stats', methods=['GET'])
+def coalesce_stats_response():
+    """
+    Return number of computations saved by attaching jobs to identical jobs in flight
+    """
+    logger.info("Got coalesce_stats request")
+    stats = webserver.tasks_runner.coalescer.get_stats()
+    logger.info("Coalesce stats: %s", str(stats))
+    return jsonify({'status' : 'done', 'data' : stats})
+
+@webserver.route('/api/queue_stats', methods=['GET'])
+def queue_stats_response():
+    """
+    Return depth of the tasks queue, its limits and number of rejected / shed jobs
+    """
+    logger.info("Got queue_stats request")
+    stats = webserver.tasks_runner.get_queue_stats()
+    logger.info("Queue stats: %s", str(stats))
+    return jsonify({'status' : 'done', 'data' : stats})
+
+def get_metrics_text():
+    """ all metrics in Prometheus text format, with gauges measured now """
+    tasks_runner = webserver.tasks_runner
+    busy = tasks_runner.metrics.get_value('asc_workers_busy')
+    gauges = [('asc_queue_depth', (), tasks_runner.tasks_queue.qsize()),
+              ('asc_workers_idle', (), tasks_runner.num_threads - busy),
+              ('asc_ingest_seconds', (), tasks_runner.data.ingest_stats['seconds']),
+              ('asc_data_rows', (), tasks_runner.data.num_rows),
+              ('asc_data_version', (), tasks_runner.data.version),
+              ('asc_log_dropped_total', (), queue_handler.dropped),
+              ('asc_events_dropped_subscribers_total', (),
+               tasks_runner.job_registry.get_dropped_subscribers())]
+    for status, count in tasks_runner.job_registry.get_counts().items():
+        gauges.append(('asc_jobs', (('status', status),), count))
+    queue_stats = tasks_runner.get_queue_stats()
+    for reason in ('rejected', 'shed'):
+        for request_type, count in sorted(queue_stats[reason].items()):
+            gauges.append(('asc_rejected_total', (('request_type', request_type),
+                                                  ('reason', reason)), count))
+    return tasks_runner.metrics.render(gauges)
+
+@webserver.route('/metrics', methods=['GET'])
+def metrics_response():
+    """
+    Return counters, latency histograms and gauges in Prometheus text format
+    """
+    return Response(get_metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@webserver.route('/api/result_store_stats', methods=['GET'])
+def result_store_stats_response():
+    """
+    Return number of stored results (in memory, on disk) and of evicted results
+    """
+    logger.info("Got result_store_stats request")
+    stats = webserver.tasks_runner.result_store.get_stats()
+    logger.info("Result store stats: %s", str(stats))
+    return jsonify({'status' : 'done', 'data' : stats})
+
+@webserver.route('/api/admin/append', methods=['POST'])
+def append_rows_request():
+    """
+    Add rows to the dataset without restart - body: csv text, header line first
+    The rows are appended to the csv file too (a reload or a restart reads them again)
+    Jobs already running finish with the data they started with
+    Return new data_version and number of rows
+    """
+    logger.info("Got append_rows request")
+    try:
+        data = webserver.tasks_runner.append_rows(request.get_data(as_text=True),
+                                                  webserver.config['DATA_CSV'])
+    except (ValueError, IndexError) as e:
+        logger.info("Append error - %s", str(e))
+        return jsonify({'status': 'error', 'reason': 'Invalid csv: ' + str(e)})
+    except OSError as e:
+        logger.info("Append error - %s", str(e))
+        return jsonify({'status': 'error', 'reason': 'Could not save rows: ' + str(e)})
+    webserver.data_ingestor = data
+    logger.info("Data version %s has %s rows", data.version, data.num_rows)
+    return jsonify({'status': 'done', 'data_version': data.version, 'num_rows': data.num_rows})
+
+@webserver.route('/api/admin/reload', methods=['POST'])
+def reload_data_request():
+    """
+    Read the csv file again (new version of the data), without restart
+    Return new data_version and number of rows
+    """
+    logger.info("Got reload_data request")
+    data = webserver.tasks_runner.reload_data(webserver.config['DATA_CSV'],
+                                              webserver.config['DATA_SNAPSHOT'])
+    webserver.data_ingestor = data
+    logger.info("Data version %s has %s rows", data.version, data.num_rows)
+    return jsonify({'status': 'done', 'data_version': data.version, 'num_rows': data.num_rows})
+
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown_response():
     """
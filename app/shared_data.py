@@ -0,0 +1,125 @@
+""" shared_data.py """
+from multiprocessing import shared_memory
+import os
+import pickle
+import numpy as np
+from app.data_ingestor import DataIngestor
+
+def share_columns(data, shared_chunks=()):
+    """
+    describe the columns of data for other processes: every chunk of rows is copied into
+    shared memory blocks, except the chunk mapped from a snapshot (already shared, only the
+    snapshot is described) and chunks of shared_chunks (returned by an earlier call, e.g. for
+    the version data was appended to), which are described again, not copied
+    return (description - small, can be sent to other processes,
+            shared chunks - [(chunk, its description, its blocks)])
+    the caller owns the blocks and has to close and unlink them at the end (see release_chunks)
+    """
+    description = {"version" : data.version, "rows" : data.num_rows,
+                   "vocabularies" : data.vocabularies, "snapshot" : data.snapshot,
+                   "chunks" : []}
+    already_shared = {id(chunk) : (chunk_description, blocks)
+                      for chunk, chunk_description, blocks in shared_chunks}
+    new_shared_chunks = []
+    for chunk in data.chunks[0 if data.snapshot is None else 1:]:
+        if id(chunk) in already_shared:
+            chunk_description, blocks = already_shared[id(chunk)]
+        else:
+            chunk_description, blocks = share_chunk(chunk)
+        description["chunks"].append(chunk_description)
+        new_shared_chunks.append((chunk, chunk_description, blocks))
+    return description, new_shared_chunks
+
+def save_description(path, description):
+    """
+    save description (see share_columns) for worker processes started later, e.g. a worker the
+    pool starts again after one exited; the file is replaced, a reader never sees half of it
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, mode = 'wb') as f:
+        pickle.dump(description, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+def load_description(path):
+    """ description saved by save_description """
+    with open(path, mode = 'rb') as f:
+        return pickle.load(f)
+
+def share_chunk(chunk):
+    """ copy columns of a chunk into shared memory blocks, return (description, blocks) """
+    description = {}
+    blocks = []
+    for column, values in chunk.items():
+        # size 0 is not allowed for shared memory
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        shared_values = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+        shared_values[:] = values
+        description[column] = (block.name, values.shape, values.dtype.str)
+        blocks.append(block)
+    return description, blocks
+
+def attach_chunk(description):
+    """ columns of a chunk shared by another process, return (chunk, blocks) """
+    chunk = {}
+    blocks = []
+    for column, (name, shape, dtype) in description.items():
+        block = shared_memory.SharedMemory(name=name)
+        chunk[column] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+    return chunk, blocks
+
+def get_first_rows(description):
+    """ where the first rows of the described data are: its snapshot or its first chunk """
+    if description["snapshot"] is not None:
+        return description["snapshot"]
+    return description["chunks"][0]
+
+def attach_columns(description, previous=None):
+    """
+    build a DataIngestor over columns shared by another process (no copy of the rows)
+    previous - (data, description) attached before by this process: if the description only
+    adds rows to it, its aggregates are extended with the new rows instead of built again
+    return (data, blocks) - blocks have to stay open while data is used
+    """
+    chunks = []
+    blocks = []
+    for chunk_description in description["chunks"]:
+        chunk, chunk_blocks = attach_chunk(chunk_description)
+        chunks.append(chunk)
+        blocks.extend(chunk_blocks)
+
+    if previous is not None and get_first_rows(previous[1]) == get_first_rows(description) and \
+            previous[1]["rows"] <= description["rows"]:
+        # same first rows, rows appended since => only the new rows are grouped
+        first_data = previous[0]
+    elif description["snapshot"] is not None:
+        first_data = DataIngestor()
+        if not first_data.map_snapshot(*description["snapshot"]):
+            release_blocks(blocks)
+            raise RuntimeError(f"Snapshot {description['snapshot'][0]} is not available")
+    else:
+        first_data = DataIngestor()
+        first_data.set_vocabularies(description["vocabularies"])
+        first_data.set_columns(chunks[0].pop("Data_Value"), chunks[0])
+        chunks[0] = first_data.chunks[0]
+
+    if description["snapshot"] is not None:
+        chunks.insert(0, first_data.chunks[0])
+    data = first_data.extend(chunks, description["vocabularies"], description["version"])
+    return data, blocks
+
+def release_blocks(blocks, unlink=False):
+    """ close shared memory blocks (and remove them, by the process that created them) """
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+
+def release_chunks(shared_chunks, keep=(), unlink=False):
+    """
+    close blocks of shared chunks (returned by share_columns) that are not in keep, another
+    list of shared chunks (and remove them, by the process that created them)
+    """
+    kept = {id(chunk) for chunk, _, _ in keep}
+    release_blocks([block for chunk, _, blocks in shared_chunks if id(chunk) not in kept
+                    for block in blocks], unlink)
@@ -0,0 +1,89 @@
+""" snapshot.py """
+import hashlib
+import json
+import os
+import pickle
+import struct
+import numpy as np
+
+# changes whenever the layout of the file changes => older snapshots are rebuilt
+SNAPSHOT_MAGIC = b'ASCSNAP3'
+# arrays start at multiples of ALIGNMENT bytes, so they can be memory-mapped as they are
+ALIGNMENT = 64
+
+def get_source_key(csv_path):
+    """ identify the contents of the csv file: size, modification time and sha256 """
+    stat = os.stat(csv_path)
+    digest = hashlib.sha256()
+    with open(csv_path, mode = 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'sha256' : digest.hexdigest()}
+
+def align(offset):
+    """ first multiple of ALIGNMENT that is >= offset """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_snapshot(snapshot_path, key, arrays, objects):
+    """
+    write snapshot of the data read from the csv file identified by key:
+    arrays (name -> numpy array) are stored raw, so they can be memory-mapped,
+    objects (name -> any picklable value, e.g. vocabularies) are pickled after them
+    the file is written next to snapshot_path and renamed => readers never see half of it
+    """
+    meta = {'key' : key, 'arrays' : {}, 'objects' : None}
+    # offsets are relative to the end of the header, which is not known yet
+    blobs = []
+    offset = 0
+    for name, values in arrays.items():
+        offset = align(offset)
+        meta['arrays'][name] = (offset, list(values.shape), values.dtype.str)
+        blobs.append((offset, np.ascontiguousarray(values).tobytes()))
+        offset += values.nbytes
+    blobs.append((offset, pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL)))
+    meta['objects'] = (offset, len(blobs[-1][1]))
+
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    data_start = align(len(SNAPSHOT_MAGIC) + 8 + len(meta_bytes))
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+    temp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+    with open(temp_path, mode = 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(meta_bytes)) + meta_bytes)
+        for blob_offset, blob in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(blob)
+    os.replace(temp_path, snapshot_path)
+
+def read_snapshot(snapshot_path, key):
+    """
+    open snapshot written from the csv file identified by key; arrays are memory-mapped
+    read-only => pages are loaded on first use and shared by all processes that map the file
+    return (arrays, objects), or None if there is no valid snapshot
+    """
+    try:
+        with open(snapshot_path, mode = 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            meta_size, = struct.unpack('<Q', f.read(8))
+            meta = json.loads(f.read(meta_size).decode('utf-8'))
+            if meta['key'] != key:
+                # csv file changed since the snapshot was written
+                return None
+            data_start = align(len(SNAPSHOT_MAGIC) + 8 + meta_size)
+            objects_offset, objects_size = meta['objects']
+            f.seek(data_start + objects_offset)
+            objects = pickle.loads(f.read(objects_size))
+
+        arrays = {}
+        for name, (offset, shape, dtype) in meta['arrays'].items():
+            if 0 in shape:
+                # empty arrays can't be memory-mapped
+                arrays[name] = np.empty(shape, dtype=np.dtype(dtype))
+            else:
+                arrays[name] = np.memmap(snapshot_path, dtype=np.dtype(dtype), mode='r',
+                                         offset=data_start + offset,
+                                         shape=tuple(shape)).view(np.ndarray)
+    except (OSError, ValueError, KeyError, EOFError, struct.error, pickle.UnpicklingError):
+        # missing, truncated or corrupted snapshot => parse the csv file again
+        return None
+    return arrays, objects
@@ -1,9 +1,266 @@
 """ task_runner.py """
-from queue import Queue
-from threading import Thread, Event
+from functools import partial
+from threading import Thread, Event, Lock
+from multiprocessing import get_context
 import json
 import os
+import tempfile
+import time
+from app.data_ingestor import DataIngestor, append_csv_file
 from app.task_solver import TaskSolver
+from app.task_scheduler import TaskScheduler
+from app.result_cache import ResultCache
+from app.result_store import create_result_store
+from app.job_registry import JobRegistry
+from app.metrics import Metrics
+from app.logging import logger
+from app.shared_data import share_columns, attach_columns, release_blocks, release_chunks, \
+    save_description, load_description
+
+# put in queue at shutdown, one for each thread
+STOP_SENTINEL = None
+
+# state of a worker process (process executor)
+WORKER = {}
+
+def get_env_int(name, default):
+    """ get integer value of environment variable (default if it is not defined) """
+    if name in os.environ:
+        return int(os.environ[name])
+    return default
+
+def get_coalesce_key(task):
+    """ identical jobs have the same request_type and the same payload """
+    payload = {key : value for key, value in task.items()
+               if key not in ('job_id', 'request_type')}
+    return task['request_type'], json.dumps(payload, sort_keys=True)
+
+def get_failure_reason(exception):
+    """ reason of a job that failed with exception """
+    return type(exception).__name__ + ': ' + str(exception)
+
+
+class JobCoalescer:
+    """
+    JobCoalescer class - remember which computations are queued or running
+    A job identical to one in flight is attached to it instead of being computed again
+    """
+    def __init__(self):
+        """ default constructor """
+        self.lock = Lock()
+        # coalesce key -> job_ids waiting for that computation
+        self.in_flight = {}
+        self.computations_saved = 0
+
+    def attach(self, key, job_id):
+        """
+        attach job_id to computation with given key
+        return True if computation is already in flight, False if it has to be started
+        """
+        with self.lock:
+            if key in self.in_flight:
+                self.in_flight[key].append(job_id)
+                self.computations_saved += 1
+                return True
+            self.in_flight[key] = [job_id]
+            return False
+
+    def detach(self, key):
+        """ computation finished - return all job_ids attached to it """
+        with self.lock:
+            return self.in_flight.pop(key)
+
+    def get_stats(self):
+        """ get number of computations saved and of computations in flight """
+        with self.lock:
+            return {'computations_saved' : self.computations_saved,
+                    'in_flight' : len(self.in_flight)}
+
+
+class QueueLimiter:
+    """
+    QueueLimiter class - admission control for the tasks queue
+    Above the soft limit only jobs that are not low priority are queued, above the maximum depth
+    every job is rejected (the client is told to retry later); both limits are checked against
+    the queue depth (in jobs) when the job arrives, plus the jobs it adds (e.g. a batch)
+    """
+    def __init__(self):
+        """ limits from TP_MAX_QUEUE (0 = unbounded), TP_QUEUE_SOFT_LIMIT, TP_LOW_PRIORITY """
+        self.max_depth = get_env_int('TP_MAX_QUEUE', 10000)
+        self.soft_limit = get_env_int('TP_QUEUE_SOFT_LIMIT', self.max_depth * 3 // 4)
+        self.low_priority = set(filter(None, os.environ.get(
+            'TP_LOW_PRIORITY', 'mean_by_category,query').split(',')))
+        # seconds after which a rejected client should try again (Retry-After)
+        self.retry_after = get_env_int('TP_RETRY_AFTER', 1)
+        # most queries in one batch (0 = unbounded)
+        self.max_batch = get_env_int('TP_MAX_BATCH', 100)
+        self.lock = Lock()
+        # request_type -> number of jobs rejected (queue full) / shed (soft limit)
+        self.rejected = {}
+        self.shed = {}
+
+    def admit(self, request_type, depth, count=1):
+        """
+        check if count jobs (e.g. the queries of a batch) can be queued when depth jobs are
+        waiting - return reason if not
+        """
+        if self.max_depth <= 0:
+            return None
+        if depth + count > self.max_depth:
+            counters, reason = self.rejected, 'Queue full'
+        elif depth + count > self.soft_limit and request_type in self.low_priority:
+            counters, reason = self.shed, 'Server busy, low priority request'
+        else:
+            return None
+        with self.lock:
+            counters[request_type] = counters.get(request_type, 0) + 1
+        return reason
+
+    def get_stats(self, depth):
+        """ get limits, current queue depth and rejection counters """
+        with self.lock:
+            return {'depth' : depth, 'max_depth' : self.max_depth,
+                    'soft_limit' : self.soft_limit, 'max_batch' : self.max_batch,
+                    'low_priority' : sorted(self.low_priority),
+                    'rejected' : dict(self.rejected), 'shed' : dict(self.shed)}
+
+def init_worker(description_path, barrier):
+    """
+    worker process: attach to the dataset shared by the server, the version current when the
+    worker starts (also for a worker the pool starts again after one exited)
+    """
+    WORKER['barrier'] = barrier
+    try:
+        attach_worker(load_description(description_path))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # a failed initializer makes the pool start the worker again and again =>
+        # the worker stays without data, its tasks fail with the reason
+        WORKER['error'] = get_failure_reason(e)
+
+def attach_worker(description):
+    """
+    worker process: use dataset described by description, release the previous one
+    (rows appended to the previous one => only they are added to its aggregates)
+    """
+    old_blocks = WORKER.get('blocks', [])
+    previous = None
+    if 'data' in WORKER:
+        previous = (WORKER.pop('data'), WORKER.pop('description'))
+        del WORKER['task_solver']
+    data, WORKER['blocks'] = attach_columns(description, previous)
+    WORKER['data'], WORKER['description'] = data, description
+    WORKER['task_solver'] = TaskSolver(data)
+    WORKER.pop('error', None)
+    # previous data doesn't use the old blocks anymore => they can be closed
+    del previous
+    release_blocks(old_blocks)
+
+def refresh_worker(description):
+    """
+    worker process: switch to a new version of the dataset
+    waits until every worker took a refresh => each worker gets exactly one of them
+    """
+    WORKER['barrier'].wait()
+    if WORKER.get('description', {}).get('version') != description['version']:
+        # a worker started after the new version was saved already uses it
+        attach_worker(description)
+
+def get_worker_solver():
+    """ worker process: solver of the dataset (RuntimeError if the worker has no data) """
+    if 'task_solver' not in WORKER:
+        raise RuntimeError('Worker process has no data: ' + WORKER.get('error', ''))
+    return WORKER['task_solver']
+
+def compute_in_worker(task):
+    """ worker process: compute result of task """
+    return get_worker_solver().compute_task(task)
+
+def compute_batch_in_worker(tasks):
+    """ worker process: compute results of all tasks of a batch """
+    return get_worker_solver().compute_batch(tasks)
+
+class ProcessExecutor:
+    """
+    ProcessExecutor class - compute tasks in worker processes (no GIL shared with the server)
+    Workers read the dataset from shared memory, they don't get a pickled copy of it
+    Workers are forked once, before the worker threads start; new versions of the data are sent
+    to them, so no process is forked while threads are running; chunks of rows already shared
+    are not copied again, so an append only shares (and workers only group) the new rows
+    The current version is also described in a file: a worker the pool starts again (after one
+    exited) reads it, so it doesn't attach to the version of the first fork
+    """
+    def __init__(self, data, num_processes):
+        """ share dataset and start worker processes """
+        self.num_processes = num_processes
+        self.lock = Lock()
+        description, self.shared_chunks = share_columns(data)
+        self.data_version = data.version
+        fd, self.description_path = tempfile.mkstemp(prefix='asc_workers_', suffix='.pickle')
+        os.close(fd)
+        save_description(self.description_path, description)
+        # fork: a spawned worker would import app and start another webserver
+        context = get_context('fork')
+        self.pool = context.Pool(num_processes, initializer=init_worker,
+                                 initargs=(self.description_path, context.Barrier(num_processes)))
+
+    def compute_task(self, task, task_solver):
+        """
+        compute result of task in a worker process (blocks only the calling thread)
+        if workers have another version of the data than task_solver (data was just
+        replaced), the task is computed by task_solver, in the calling thread
+        """
+        pending = None
+        with self.lock:
+            if self.data_version == task_solver.data.version:
+                pending = self.pool.apply_async(compute_in_worker, (task,))
+        if pending is None:
+            return task_solver.compute_task(task)
+        return pending.get()
+
+    def compute_batch(self, tasks, task_solver):
+        """
+        compute results of all tasks of a batch in one worker process (they share their work,
+        see TaskSolver.compute_batch); by task_solver if workers have another version of the data
+        """
+        pending = None
+        with self.lock:
+            if self.data_version == task_solver.data.version:
+                pending = self.pool.apply_async(compute_batch_in_worker, (tasks,))
+        if pending is None:
+            return task_solver.compute_batch(tasks)
+        return pending.get()
+
+    def parse_csv(self, function, parts):
+        """ parse parts of a csv file in the worker processes (see DataIngestor.read_csv) """
+        return self.pool.starmap(function, parts)
+
+    def refresh(self, data):
+        """
+        attach workers to new data; tasks queued before are solved from the old version,
+        tasks queued after it from the new one; old chunks are removed when no worker uses them
+        """
+        description, shared_chunks = share_columns(data, self.shared_chunks)
+        # saved before the workers are told => a worker started from now on uses the new version
+        save_description(self.description_path, description)
+        with self.lock:
+            refreshed = [self.pool.apply_async(refresh_worker, (description,))
+                         for _ in range(self.num_processes)]
+            old_shared_chunks = self.shared_chunks
+            self.shared_chunks, self.data_version = shared_chunks, data.version
+        for pending in refreshed:
+            pending.get()
+        release_chunks(old_shared_chunks, keep=shared_chunks, unlink=True)
+
+    def shutdown(self):
+        """
+        stop worker processes and remove shared dataset (called when no thread waits for
+        a result anymore)
+        """
+        # close + join would wait forever for a task lost with a worker that exited
+        self.pool.terminate()
+        self.pool.join()
+        release_chunks(self.shared_chunks, unlink=True)
+        os.remove(self.description_path)
 
 class ThreadPool:
     """
@@ -18,97 +275,285 @@ class ThreadPool:
     """
     def __init__(self, data):
         """ default constructor """
-        self.tasks_queue = Queue()
+        # cheapest expected task first, expensive ones delayed at most TP_SCHED_MAX_DELAY seconds
+        self.tasks_queue = TaskScheduler(
+            float(os.environ.get('TP_SCHED_SECONDS_PER_COST', 0.0001)),
+            float(os.environ.get('TP_SCHED_MAX_DELAY', 1)))
         self.num_threads = self.get_num_threads()
         self.threads = []
         self.shutdown_event = Event()
-        self.tasks_state = []
+        # job ids and status of every job
+        self.job_registry = JobRegistry()
+        # current version of the data; replaced (not changed) when rows are added
         self.data = data
+        # one writer at a time => every new version is built from the latest one
+        self.data_lock = Lock()
+        # results of finished jobs (memory, spilled to disk / files, see result_store.py)
+        self.result_store = create_result_store()
+        # identical jobs in flight share one computation
+        self.coalescer = JobCoalescer()
+        # bounded queue: jobs are rejected (or low priority ones shed) when it is too long
+        self.limiter = QueueLimiter()
+        # counters and latency histograms, exported by /metrics
+        self.metrics = Metrics()
+        self.metrics.add('asc_workers_busy', value=0)
+        # TP_EXECUTOR=process => threads hand the computation to worker processes
+        self.executor = None
+        if os.environ.get('TP_EXECUTOR', 'thread') == 'process':
+            # processes are forked before the worker threads are started
+            self.executor = ProcessExecutor(data, self.num_threads)
+        # one solver (and one result cache) shared by all threads, replaced with the data;
+        # a job uses the solver it started with, so it sees one version of the data
+        self.task_solver = TaskSolver(data, ResultCache(
+            get_env_int('TP_CACHE_MAX_ENTRIES', 256),
+            get_env_int('TP_CACHE_MAX_BYTES', 16 * 1024 * 1024)))
         # create and start threads
         self.create_threads()
 
     def get_num_threads(self):
         """ get number of threads """
-        if 'TP_NUM_OF_THREADS' in os.environ:
-            return os.environ['TP_NUM_OF_THREADS']
-        return os.cpu_count()
+        return get_env_int('TP_NUM_OF_THREADS', os.cpu_count())
 
     def create_threads(self):
         """ create threads """
         for i in range(self.num_threads):
             # add thread to list
-            self.threads.append(TaskRunner(i, self.tasks_queue, self.tasks_state,
-                                           self.shutdown_event, self.data))
+            self.threads.append(TaskRunner(i, self))
             self.threads[i].start()
 
+    def check_capacity(self, request_type, count=1):
+        """ check if count jobs of request_type can be queued now - return reason if not """
+        return self.limiter.admit(request_type, self.tasks_queue.qsize(), count)
+
+    def get_queue_stats(self):
+        """ get depth of the tasks queue, its limits and rejection counters """
+        return self.limiter.get_stats(self.tasks_queue.qsize())
+
+    def get_task_cost(self, task):
+        """ estimated cost of task, used to schedule it (0 if its result is cached) """
+        if self.task_solver.is_cached(task):
+            return 0
+        return self.task_solver.estimate_cost(task)
+
     # add task to queue as dictionary
     def add_task(self, task, request_type, job_id):
         """ add task to queue """
         task['job_id'] = job_id
         task['request_type'] = request_type
-        self.tasks_queue.put(task)
-        # remember threads' state - currently running
-        self.tasks_state.append({job_id : 'running'})
+        # job_id was allocated by job_registry, so it is already marked as running
+        # jobs added after new rows don't wait for a computation on older data
+        task['coalesce_key'] = (get_coalesce_key(task), self.data.version)
+        # before attaching => a task that can't be queued leaves no computation in flight
+        cost = self.get_task_cost(task)
+        if self.coalescer.attach(task['coalesce_key'], job_id):
+            # identical job already queued or running => it will be done together with it
+            return
+        # monotonic clock for the metrics, wall clock for the timing block of the job
+        task['enqueue_time'] = time.monotonic()
+        task['enqueued_at'] = time.time()
+        self.tasks_queue.put(task, cost)
+
+    def add_batch(self, tasks, job_ids):
+        """
+        add many tasks (dictionaries with request_type and query) to queue as one batch task,
+        solved together by one thread
+        """
+        for task, job_id in zip(tasks, job_ids):
+            task['job_id'] = job_id
+        self.tasks_queue.put({'request_type': 'batch', 'tasks': tasks,
+                              'enqueue_time': time.monotonic(), 'enqueued_at': time.time()},
+                             sum(self.get_task_cost(task) for task in tasks), len(tasks))
+
+    def solve_inline(self, task, request_type, max_cost):
+        """
+        solve task in the calling thread if its result is cached or its estimated cost
+        is at most max_cost - return result status (with data_version), or None if the task
+        has to be queued; it needs no job_id, so it doesn't take a place in the queue
+        """
+        task['request_type'] = request_type
+        task_solver = self.task_solver
+        if not task_solver.is_cached(task) and task_solver.estimate_cost(task) > max_cost:
+            return None
+        try:
+            result = task_solver.solve_task(task)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # let the queue handle tasks that can't be solved
+            return None
+        return {'status': 'done', 'data': result, 'data_version': task_solver.data.version}
+
+    def finish_inline(self, job_id, result_status):
+        """ store result of a task solved inline (see solve_inline), mark job_id as done """
+        self.result_store.put(job_id, result_status)
+        self.job_registry.set_status(job_id, 'done')
+
+    def set_data(self, data):
+        """ use new version of the data for jobs that start from now on """
+        self.task_solver = TaskSolver(data, self.task_solver.cache)
+        self.data = data
+        if self.executor is not None:
+            self.executor.refresh(data)
+
+    def append_rows(self, text, csv_path=None):
+        """
+        add rows of csv text (header line first) to the data, without restart
+        csv_path - the rows are also appended to this csv file, so a reload, a restart and
+        other server processes (after a reload) read them too
+        return new version of the data (ValueError if text is not valid, OSError if the csv
+        file can't be written - the data doesn't change then)
+        """
+        with self.data_lock:
+            data = self.data.append_csv(text)
+            if csv_path is not None:
+                append_csv_file(csv_path, text)
+            self.set_data(data)
+        return data
+
+    def reload_data(self, csv_path, snapshot_path):
+        """ read csv file again (or its snapshot), as a new version of the data """
+        with self.data_lock:
+            # threads are running => no new processes: the csv file is parsed by the worker
+            # processes (TP_EXECUTOR=process) or in this thread
+            data = DataIngestor(csv_path, num_workers=self.get_parse_workers(),
+                                snapshot_path=snapshot_path, executor=self.executor)
+            data.version = self.data.version + 1
+            self.set_data(data)
+        return data
+
+    def get_parse_workers(self):
+        """ number of processes that parse a csv file read while threads are running """
+        return 1 if self.executor is None else self.executor.num_processes
 
     def check_valid_job_id(self, job_id):
         """ check if job_id is valid """
-        for task in self.tasks_state:
-            if job_id in task:
-                # job exists in list => valid job_id
-                return True
-        return False
+        return self.job_registry.is_valid(job_id)
 
     def shutdown(self):
         """ set shutdown event to notify threads to stop when queue is empty """
         self.shutdown_event.set()
+        # one stop sentinel per thread, taken after all tasks => threads drain the queue first
+        for _ in self.threads:
+            self.tasks_queue.put_last(STOP_SENTINEL)
         # wait for threads to finish all tasks
-        while True:
-            if self.tasks_queue.empty() is False:
-                continue
-            break
         for thread in self.threads:
             thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
 
 
 class TaskRunner(Thread):
     """ TaskRunner class - run tasks """
-    def __init__(self, idx, tasks_queue, tasks_state, shutdown_event, data):
+    def __init__(self, idx, thread_pool):
         """ default constructor """
         Thread.__init__(self)
         self.idx = idx
-        self.tasks_queue = tasks_queue
-        self.tasks_state = tasks_state
-        self.shutdown_event = shutdown_event
-        self.data = data
-        self.task_solver = TaskSolver(self.data)
+        self.tasks_queue = thread_pool.tasks_queue
+        self.job_registry = thread_pool.job_registry
+        self.thread_pool = thread_pool
+        self.coalescer = thread_pool.coalescer
+        self.result_store = thread_pool.result_store
+        self.metrics = thread_pool.metrics
+        # compute in this thread (None) or in a worker process
+        self.executor = thread_pool.executor
 
     def run(self):
         """ run tasks """
         while True:
-            # if event is set an queue empty => time to end thread
-            if self.shutdown_event.is_set() and self.tasks_queue.empty():
+            # get task from queue (blocking, the thread sleeps until there is a task)
+            task = self.tasks_queue.get()
+            if task is STOP_SENTINEL:
+                # shutdown and every task before the sentinel was taken => time to end thread
                 break
 
-            # if queue is empty => continue till is_set() or queue not empty
-            # somehow save thread from waiting forever for queue.get()
-            if self.tasks_queue.empty() is False:
-                # get task from queue (blocking, so it waits until there is a task in the queue,
-                # which could block programme at shutdown - deadlock, so we check before if queue is empty)
-                task = self.tasks_queue.get()
-            else:
-                # check again if event is set again
-                continue
+            # timestamps (wall clock) of the jobs done with this task, returned by get_results;
+            # durations for the metrics are measured with the monotonic clock
+            timing = {'worker': self.idx, 'enqueued': task['enqueued_at'], 'started': time.time()}
+            self.metrics.observe('asc_queue_wait_seconds',
+                                 time.monotonic() - task['enqueue_time'],
+                                 (('request_type', task['request_type']),))
+            self.metrics.add('asc_workers_busy')
+            # whole job is solved from the version of the data current when it starts
+            task_solver = self.thread_pool.task_solver
+            try:
+                if task['request_type'] == 'batch':
+                    self.run_batch(task_solver, task['tasks'], timing)
+                else:
+                    self.run_task(task_solver, task, timing)
+            finally:
+                self.metrics.add('asc_workers_busy', value=-1)
 
-            # solve task
-            result = TaskSolver.solve_task(self.task_solver, task)
+    def run_task(self, task_solver, task, timing):
+        """ solve task, mark it and all identical jobs attached to it as done (or failed) """
+        compute = None
+        if self.executor is not None:
+            compute = partial(self.executor.compute_task, task_solver=task_solver)
+        start = time.monotonic()
+        try:
+            result = TaskSolver.solve_task(task_solver, task, compute)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # a job that can't be solved fails (with a reason), it never stays running
+            timing['solved'] = time.time()
+            for job_id in self.coalescer.detach(task['coalesce_key']):
+                self.fail_job(job_id, task['request_type'], get_failure_reason(e), timing)
+            return
+        timing['solved'] = time.time()
+        self.metrics.observe('asc_solve_seconds', time.monotonic() - start,
+                             (('request_type', task['request_type']),))
+
+        result_status = {'status': 'done', 'data': result,
+                         'data_version': task_solver.data.version}
+        # task and all identical jobs attached to it are done together
+        for job_id in self.coalescer.detach(task['coalesce_key']):
+            self.finish_job(job_id, task['request_type'], result_status, timing)
+
+    def run_batch(self, task_solver, tasks, timing):
+        """ solve all tasks of a batch together, mark each job as done (or failed) """
+        compute_batch = None
+        if self.executor is not None:
+            compute_batch = partial(self.executor.compute_batch, task_solver=task_solver)
+        start = time.monotonic()
+        try:
+            results = task_solver.solve_batch(tasks, compute_batch)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # e.g. a worker process failed => every job of the batch fails, none stays running
+            timing['solved'] = time.time()
+            for task in tasks:
+                self.fail_job(task['job_id'], task['request_type'], get_failure_reason(e), timing)
+            return
+        timing['solved'] = time.time()
+        self.metrics.observe('asc_solve_seconds', time.monotonic() - start,
+                             (('request_type', 'batch'),))
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                self.fail_job(task['job_id'], task['request_type'], get_failure_reason(result),
+                              timing)
+                continue
+            self.finish_job(task['job_id'], task['request_type'],
+                            {'status': 'done', 'data': result,
+                             'data_version': task_solver.data.version}, timing)
 
-            result_status = {'status': 'done', 'data': result}
-            # create file and write result to it as json
-            file_name = 'results/' + task['job_id'] + '.txt'
-            with open(file_name, 'w', encoding='utf-8') as f:
-                json.dump(result_status, f)
+    def finish_job(self, job_id, request_type, result_status, timing):
+        """
+        store result of job_id (before marking the job as done), mark it as done
+        if the result can't be stored or the job marked, the job fails with the reason
+        """
+        try:
+            start = time.monotonic()
+            self.result_store.put(job_id, result_status)
+            self.metrics.observe('asc_result_write_seconds', time.monotonic() - start)
+            self.job_registry.set_status(job_id, 'done',
+                                         timing=dict(timing, persisted=time.time()))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # the thread goes on with the other jobs of the task, none of them stays running
+            self.fail_job(job_id, request_type, get_failure_reason(e), timing)
+            return
+        self.metrics.add('asc_jobs_total', (('request_type', request_type), ('status', 'done')))
 
-            # get job_id index as int
-            index = int(task['job_id'].split('_').pop()) - 1
-            # mark task as done
-            self.tasks_state[index][task['job_id']] = "done"
+    def fail_job(self, job_id, request_type, reason, timing):
+        """ mark job_id as failed """
+        try:
+            self.job_registry.set_status(job_id, 'failed', reason, dict(timing))
+        except Exception:  # pylint: disable=broad-exception-caught
+            # e.g. job_id is not registered => nothing to mark, the thread keeps running
+            logger.exception("Could not mark job_id %s as failed (%s)", job_id, reason)
+            return
+        self.metrics.add('asc_jobs_total', (('request_type', request_type), ('status', 'failed')))
@@ -0,0 +1,59 @@
+""" task_scheduler.py """
+import heapq
+import math
+import time
+from threading import Condition
+
+class TaskScheduler:
+    """
+    TaskScheduler class - queue of tasks, cheapest expected task first, with aging
+    Every task gets a deadline: the time it was added plus a delay that grows with its estimated
+    cost (at most max_delay seconds). Threads take the task with the earliest deadline, so cheap
+    tasks overtake expensive ones, but no task added after the deadline of a task overtakes it
+    => an expensive task waits at most max_delay seconds longer than in FIFO order
+    seconds_per_cost = 0 gives FIFO order
+    A task has a size, the number of jobs it solves (e.g. the queries of a batch): qsize counts
+    jobs, so a batch weighs on the queue limits like the jobs it holds
+    """
+    def __init__(self, seconds_per_cost, max_delay):
+        """ default constructor """
+        self.seconds_per_cost = seconds_per_cost
+        self.max_delay = max_delay
+        self.condition = Condition()
+        # heap of (deadline, sequence number, task); sequence keeps FIFO order between equal
+        # deadlines and tasks themselves are never compared
+        self.heap = []
+        self.sequence = 0
+        # sum of the sizes of the waiting tasks
+        self.size = 0
+
+    def push(self, deadline, task, size):
+        """ add task with given deadline and size, wake up one waiting thread """
+        with self.condition:
+            heapq.heappush(self.heap, (deadline, self.sequence, size, task))
+            self.sequence += 1
+            self.size += size
+            self.condition.notify()
+
+    def put(self, task, cost=0, size=1):
+        """ add task with estimated cost, that solves size jobs """
+        self.push(time.monotonic() + min(cost * self.seconds_per_cost, self.max_delay), task,
+                  size)
+
+    def put_last(self, task):
+        """ add task that is taken only after every other task (e.g. stop sentinel) """
+        self.push(math.inf, task, 1)
+
+    def get(self):
+        """ take task with the earliest deadline (blocking, sleeps until there is one) """
+        with self.condition:
+            while not self.heap:
+                self.condition.wait()
+            _, _, size, task = heapq.heappop(self.heap)
+            self.size -= size
+            return task
+
+    def qsize(self):
+        """ number of jobs of the waiting tasks """
+        with self.condition:
+            return self.size
@@ -1,13 +1,87 @@
 """ task_solver.py """
+import json
+import math
+import numpy as np
+
+# aggregates that can be used in /api/query
+QUERY_AGGREGATES = ('mean', 'sum', 'count', 'min', 'max')
+# request types about one state of a question
+STATE_REQUEST_TYPES = ('state_mean', 'state_diff_from_mean', 'state_mean_by_category')
+
+def is_filter_value(value):
+    """ check if value can be matched against a column: string or integral number, not a bool """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return value.is_integer()
+    return isinstance(value, (str, int))
+
+def get_filter_text(value):
+    """ text of a filter value, as it is in the csv file (2011.0 and 2011 -> '2011') """
+    if isinstance(value, float):
+        return str(int(value))
+    return str(value)
 
 class TaskSolver:
     """ TaskSolver class - solve tasks """
-    def __init__(self, data):
-        """ Initialize TaskSolver class """
+    def __init__(self, data, cache=None):
+        """ Initialize TaskSolver class (cache - ResultCache shared by threads, optional) """
         self.data = data
+        self.cache = cache
+
+    def solve_task(self, task, compute=None):
+        """
+        solve task, or get its result from cache if it was already solved
+        compute - function used to compute results (default: compute_task, in this thread)
+        """
+        if compute is None:
+            compute = self.compute_task
+        if self.cache is None:
+            return compute(task)
+        key = self.get_cache_key(task)
+        # read version once, so the result is cached for the data it was computed from
+        data_version = self.data.version
+        task_res = self.cache.get(key, data_version)
+        if task_res is None:
+            task_res = compute(task)
+            self.cache.put(key, task_res, data_version)
+        return task_res
+
+    def get_cache_key(self, task):
+        """
+        key of task result in cache, made only of the fields the request type uses
+        => requests with the same answer share one entry, other fields are ignored
+        """
+        if task['request_type'] == 'query':
+            return 'query', json.dumps([task.get('filters', {}), task.get('group_by', []),
+                                        task.get('aggregate', 'mean')], sort_keys=True)
+        if task['request_type'] in STATE_REQUEST_TYPES:
+            return task['request_type'], task.get('question'), task.get('state')
+        return task['request_type'], task.get('question'), None
+
+    def is_cached(self, task):
+        """ check if result of task is already in cache """
+        return self.cache is not None and \
+            self.cache.contains(self.get_cache_key(task), self.data.version)
 
-    def solve_task(self, task):
-        """ solve task """
+    def estimate_cost(self, task):
+        """ estimated cost of task: number of precomputed groups (sum, count) it reads """
+        q = task.get('question')
+        if task['request_type'] == 'query':
+            # reads every row
+            return self.data.num_rows
+        if task['request_type'] in ('state_mean', 'state_diff_from_mean'):
+            return 2
+        if task['request_type'] == 'state_mean_by_category':
+            return len(self.data.get_category_aggregates(q, task.get('state')))
+        if task['request_type'] == 'mean_by_category':
+            return sum(len(self.data.get_category_aggregates(q, state))
+                       for state in self.get_states_helper(q))
+        # one group for each state
+        return len(self.data.get_locations(q)) + 1
+
+    def compute_task(self, task):
+        """ compute result of task """
         task_res = {}
         if task['request_type'] == 'state_mean':
             task_res = self.state_mean(task['question'], task['state'])
@@ -27,47 +101,107 @@ class TaskSolver:
             task_res = self.state_mean_by_category(task['question'], task['state'])
         elif task['request_type'] == 'mean_by_category':
             task_res = self.get_mean_by_category(task['question'])
+        elif task['request_type'] == 'query':
+            task_res = self.query(task.get('filters', {}), task.get('group_by', []),
+                                  task.get('aggregate', 'mean'))
         return task_res
 
+    def solve_batch(self, tasks, compute_batch=None):
+        """
+        solve many tasks at once, results already in cache are read from it
+        compute_batch - function used to compute results of the other tasks
+        (default: compute_batch, in this thread)
+        return list with the result of each task (or the exception raised while solving it)
+        """
+        if compute_batch is None:
+            compute_batch = self.compute_batch
+        if self.cache is None:
+            return compute_batch(tasks)
+        keys = [self.get_cache_key(task) for task in tasks]
+        # read version once, so results are cached for the data they were computed from
+        data_version = self.data.version
+        results = [self.cache.get(key, data_version) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, compute_batch([tasks[i] for i in missing])):
+                results[i] = result
+                if not isinstance(result, Exception):
+                    self.cache.put(keys[i], result, data_version)
+        return results
+
+    def compute_batch(self, tasks):
+        """
+        compute results of many tasks at once: tasks about the same question share the
+        average values of the states and the global mean, computed once for each question
+        return list with the result of each task (or the exception raised while computing it)
+        """
+        results = [None] * len(tasks)
+        questions = {}
+        for i, task in enumerate(tasks):
+            questions.setdefault(task.get('question'), []).append(i)
+        for indexes in questions.values():
+            # values shared by all tasks about this question
+            shared = {}
+            for i in indexes:
+                try:
+                    results[i] = self.compute_shared_helper(tasks[i], shared)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    results[i] = e
+        return results
+
+    def compute_shared_helper(self, task, shared):
+        """ compute result of task, reusing the values shared by tasks about its question """
+        q = task['question']
+        if task['request_type'] in ('states_mean', 'best5', 'worst5', 'diff_from_mean') and \
+                'states_values' not in shared:
+            shared['states_values'] = self.get_states_values_helper(q)
+        if task['request_type'] in ('global_mean', 'diff_from_mean') and \
+                'global_mean' not in shared:
+            shared['global_mean'] = self.global_mean(q)
+
+        if task['request_type'] == 'states_mean':
+            return self.states_mean(q, shared['states_values'])
+        if task['request_type'] == 'best5':
+            return self.best5(q, shared['states_values'])
+        if task['request_type'] == 'worst5':
+            return self.worst5(q, shared['states_values'])
+        if task['request_type'] == 'global_mean':
+            return shared['global_mean']
+        if task['request_type'] == 'diff_from_mean':
+            return self.diff_from_mean(q, shared['states_values'], shared['global_mean'])
+        # tasks about one state read only a few precomputed values
+        return self.compute_task(task)
+
     def get_states_values_helper(self, q):
         """ get states after question and location """
         states_values = {}
-        states_num = {}
-        # get each row from file
-        for row in self.data.list_data:
-            # same question
-            if row['Question'] == q:
-                if row['Location'] not in states_values:
-                    # location hasn't been added yet to dictionary => add it
-                    states_values[row['Location']] = float(row['Data_Value'])
-                    states_num[row['Location']] = 1
-                else:
-                    # location already in dictionary => add new value to sum
-                    states_values[row['Location']] += float(row['Data_Value'])
-                    states_num[row['Location']] += 1
-        for state in states_values:
+        for location in self.data.get_locations(q):
+            state = self.data.decode('Location', location)
             # average value for each state
-            states_values[state] = states_values[state] / states_num[state]
+            states_values[state] = self.get_mean_helper(*self.data.get_aggregate(q, state))
         # return dictionary
         return states_values
 
+    def get_mean_helper(self, summ, numm):
+        """
+        average value of a precomputed group (sum, count)
+        ValueError if one of its values is not a number (NaN, see data_ingestor.get_values)
+        """
+        if math.isnan(summ):
+            raise ValueError('Data_Value is not a number')
+        return summ / numm
+
     def state_mean(self, q, state):
         """ /api/state_mean """
-        numm = 0
-        summ = 0
-        for row in self.data.list_data:
-            if row['Question'] == q and row['Location'] == state:
-                # add to sum and count number of values
-                summ += float(row['Data_Value'])
-                numm += 1
-
-        value = summ / numm
+        # precomputed sum and number of values
+        value = self.get_mean_helper(*self.data.get_aggregate(q, state))
         return {state : value}
 
-    def best5(self, q):
+    def best5(self, q, states_values=None):
         """ /api/best5 """
-        # get average values for each state
-        states_values = self.get_states_values_helper(q)
+        # get average values for each state (unless they were already computed)
+        if states_values is None:
+            states_values = self.get_states_values_helper(q)
         sorted_states = {}
 
         if q in self.data.questions_best_is_min:
@@ -85,10 +219,11 @@ class TaskSolver:
 
         return sorted_states
 
-    def worst5(self, q):
+    def worst5(self, q, states_values=None):
         """ api/worst5 """
-        # get average values for each state
-        states_values = self.get_states_values_helper(q)
+        # get average values for each state (unless they were already computed)
+        if states_values is None:
+            states_values = self.get_states_values_helper(q)
         sorted_states = {}
 
         if q in self.data.questions_best_is_min:
@@ -106,10 +241,11 @@ class TaskSolver:
 
         return sorted_states
 
-    def states_mean(self, q):
+    def states_mean(self, q, states_values=None):
         """ /api/states_mean """
-        # get average values for each state
-        states_values = self.get_states_values_helper(q)
+        # get average values for each state (unless they were already computed)
+        if states_values is None:
+            states_values = self.get_states_values_helper(q)
         sorted_states = {}
         # sort states by value
         for state in sorted(states_values, key=states_values.get, reverse=False):
@@ -119,22 +255,18 @@ class TaskSolver:
 
     def global_mean(self, q):
         """ /api/global_mean """
-        sum_global = 0
-        num = 0
-        for row in self.data.list_data:
-            # only look after question (location doesn't matter)
-            if row['Question'] == q:
-                sum_global += float(row['Data_Value'])
-                num += 1
-        val = sum_global / num
+        # only look after question (location doesn't matter)
+        val = self.get_mean_helper(*self.data.get_aggregate(q))
         return {"global_mean" : val}
 
-    def diff_from_mean(self, q):
+    def diff_from_mean(self, q, states_values=None, global_mean_var=None):
         """ /api/diff_from_mean """
-        # get average values for each state
-        states_values = self.get_states_values_helper(q)
+        # get average values for each state (unless they were already computed)
+        if states_values is None:
+            states_values = self.get_states_values_helper(q)
         # get average value for question (from all states)
-        global_mean_var = self.global_mean(q)
+        if global_mean_var is None:
+            global_mean_var = self.global_mean(q)
 
         states_diff = {}
         for state_mean in states_values:
@@ -153,12 +285,7 @@ class TaskSolver:
 
     def get_states_helper(self, q):
         """ function that returns a list of all states that answered the given question """
-        states = []
-        for row in self.data.list_data:
-            if row['Question'] == q:
-                if row['Location'] not in states:
-                    states.append(row['Location'])
-        return states
+        return [self.data.decode('Location', location) for location in self.data.get_locations(q)]
 
     def get_category_name_helper(self, category, state, stratification_category, stratification):
         """ 
@@ -171,33 +298,24 @@ class TaskSolver:
 
     def get_state_mean_by_category(self, q, state, category):
         """ function that returns the average values for each category """
+        empty_category = self.data.get_code('Stratification_Category', '')
+        empty_stratification = self.data.get_code('Stratification', '')
         dict_categories = {}
-        dict_num_cat = {}
-        for row in self.data.list_data:
-            if row['Stratification_Category'] == '' or row['Stratification'] == '':
+        for (category_code, stratification_code), (summ, numm) in \
+                self.data.get_category_aggregates(q, state).items():
+            if category_code == empty_category or stratification_code == empty_stratification:
                 # ignore rows with empty values
                 continue
-            if row['Question'] == q and row['Location'] == state:
-                # get category name
-                category_name = self.get_category_name_helper(category, state,
-                                                            row['Stratification_Category'],
-                                                            row['Stratification'])
-                if category_name not in dict_categories:
-                    # category hasn't been added yet to dictionary => add it
-                    dict_categories[category_name] = float(row['Data_Value'])
-                    dict_num_cat[category_name] = 1
-                else:
-                    # category already in dictionary => add new value to sum
-                    dict_categories[category_name] += float(row['Data_Value'])
-                    dict_num_cat[category_name] += 1
-
-        dict_answer = {}
-        # sort after keys (alphabetically)
-        for row in sorted(dict_categories.keys()):
+            # get category name
+            category_name = self.get_category_name_helper(
+                category, state,
+                self.data.decode('Stratification_Category', category_code),
+                self.data.decode('Stratification', stratification_code))
             # calculate average value for each category
-            dict_answer[row] = dict_categories[row] / dict_num_cat[row]
+            dict_categories[category_name] = self.get_mean_helper(summ, numm)
 
-        return dict_answer
+        # sort after keys (alphabetically)
+        return {name : dict_categories[name] for name in sorted(dict_categories)}
 
     def get_mean_by_category(self, q):
         """ /api/mean_by_category """
@@ -220,3 +338,126 @@ class TaskSolver:
         dict_categories = self.get_state_mean_by_category(q, state, 'no_state')
         # add values to dictionary
         return {state : dict_categories}
+
+    def check_task(self, task, request_type):
+        """
+        return reason why task can't be solved, None if it can
+        question and state are looked up in the precomputed (sum, count) groups => O(1)
+        """
+        if request_type == 'query':
+            if not isinstance(task, dict):
+                return 'Invalid query'
+            return self.check_query(task.get('filters', {}), task.get('group_by', []),
+                                    task.get('aggregate', 'mean'))
+        if not isinstance(task, dict):
+            return 'Invalid request'
+        q = task.get('question')
+        if not isinstance(q, str):
+            return 'Missing question'
+        if self.data.get_aggregate(q)[1] == 0:
+            return 'Unknown question'
+        state = task.get('state')
+        if request_type in STATE_REQUEST_TYPES:
+            if not isinstance(state, str):
+                return 'Missing state'
+            if self.data.get_aggregate(q, state)[1] == 0:
+                return 'Unknown state'
+        elif state is not None and not isinstance(state, str):
+            # not used by the other endpoints, but part of the job (coalescing, cache)
+            return 'Invalid state'
+        return None
+
+    def check_query(self, filters, group_by, aggregate):
+        """ return reason why the query is not valid, None if it is valid """
+        if not isinstance(filters, dict) or not isinstance(group_by, list):
+            return 'filters must be an object and group_by a list'
+        for column in list(filters) + group_by:
+            # names must be strings before they are looked up (lists are not hashable)
+            if not isinstance(column, str) or column not in self.data.vocabularies:
+                return 'Unknown column ' + str(column)
+        for column, values in filters.items():
+            if not isinstance(values, list):
+                values = [values]
+            if not all(is_filter_value(value) for value in values):
+                return 'Filter values of ' + column + ' must be strings or integers'
+        if aggregate not in QUERY_AGGREGATES:
+            return 'Unknown aggregate ' + str(aggregate)
+        # group keys are combined in one int64
+        if np.prod([float(max(len(self.data.vocabularies[column]), 1))
+                    for column in group_by]) >= 2 ** 62:
+            return 'Too many groups'
+        return None
+
+    def query(self, filters, group_by, aggregate):
+        """
+        /api/query - aggregate Data_Value of the rows that match filters
+        ({column : value or list of values}), grouped by the given columns
+        result keys: group values ('value' or "('value1', 'value2')"), sorted alphabetically
+        """
+        allowed = {}
+        for column, values in filters.items():
+            if not isinstance(values, list):
+                values = [values]
+            allowed[column] = [self.data.get_code(column, get_filter_text(value))
+                               for value in values]
+        # chunk by chunk (rows appended later are in other chunks), in row order
+        selected = [self.select_rows_helper(chunk, allowed, group_by)
+                    for chunk in self.data.chunks]
+        keys = np.concatenate([chunk_keys for chunk_keys, _ in selected])
+        values = np.concatenate([chunk_values for _, chunk_values in selected])
+        groups, group_of_row = np.unique(keys, return_inverse=True)
+        if aggregate != 'count' and np.isnan(values).any():
+            raise ValueError('Data_Value is not a number')
+        group_values = self.aggregate_helper(values, group_of_row, len(groups), aggregate)
+
+        if not group_by:
+            return {aggregate : group_values[0]} if len(values) > 0 else {}
+        result = {self.get_group_name_helper(group, group_by) : value
+                  for group, value in zip(groups.tolist(), group_values)}
+        return {name : result[name] for name in sorted(result)}
+
+    def select_rows_helper(self, chunk, allowed, group_by):
+        """
+        rows of a chunk of the data whose codes are allowed ({column : allowed codes})
+        return (group key of each row, their Data_Value)
+        """
+        mask = np.ones(len(chunk['Data_Value']), dtype=bool)
+        for column, codes in allowed.items():
+            mask &= np.isin(chunk[column], codes)
+        rows = np.flatnonzero(mask)
+
+        # one integer key for each combination of values of the group_by columns
+        keys = np.zeros(len(rows), dtype=np.int64)
+        for column in group_by:
+            keys = keys * len(self.data.vocabularies[column]) + chunk[column][rows]
+        return keys, chunk['Data_Value'][rows]
+
+    def get_group_name_helper(self, group, group_by):
+        """ decode group key of a query: 'value' or "('value1', 'value2')" """
+        names = []
+        # last column first
+        for column in reversed(group_by):
+            size = len(self.data.vocabularies[column])
+            names.append(self.data.decode(column, group % size))
+            group //= size
+        names.reverse()
+        return names[0] if len(names) == 1 else str(tuple(names))
+
+    def aggregate_helper(self, values, group_of_row, num_groups, aggregate):
+        """ aggregate values of each group (vectorized), return list of python numbers """
+        if num_groups == 0:
+            return []
+        counts = np.bincount(group_of_row, minlength=num_groups)
+        if aggregate == 'count':
+            return counts.tolist()
+        if aggregate in ('mean', 'sum'):
+            # bincount adds values in row order, like the other endpoints
+            sums = np.bincount(group_of_row, weights=values, minlength=num_groups)
+            if aggregate == 'sum':
+                return sums.tolist()
+            return (sums / counts).tolist()
+        # min / max: sort values by group, reduce each group's slice
+        order = np.argsort(group_of_row, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        reduce = np.minimum if aggregate == 'min' else np.maximum
+        return reduce.reduceat(values[order], starts).tolist()
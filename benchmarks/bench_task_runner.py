@@ -0,0 +1,159 @@
+"""
+bench_task_runner.py - idle CPU usage of the ThreadPool, enqueue -> pickup latency, latency of
+cheap jobs queued together with expensive ones, in FIFO order and cheapest expected job first,
+and latency of get_results requests with logging off, queued (background thread) and synchronous
+"""
+import os
+import sys
+import tempfile
+import time
+from threading import Event
+
+# results must not be cached, every task has to reach a thread
+os.environ['TP_CACHE_MAX_ENTRIES'] = '0'
+# thousands of get_results requests are logged => not in app/webserver.log (and its rotations)
+os.environ.setdefault('TP_LOG_FILE',
+                      os.path.join(tempfile.mkdtemp(prefix='asc_bench_'), 'webserver.log'))
+
+from app import webserver
+from app.data_ingestor import DataIngestor
+from app.logging import logger, handler, queue_handler
+from app.task_runner import ThreadPool
+
+IDLE_SECONDS = 2
+NUM_TASKS = 200
+# jobs of the mixed burst: one expensive job for every cheap one
+NUM_MIXED_TASKS = 400
+# get_results requests for each logging mode
+NUM_REQUESTS = 1000
+
+def measure_idle_cpu(seconds):
+    """ percent of one core used by the whole process while no task is queued """
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    time.sleep(seconds)
+    return 100 * (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+def measure_pickup_latency(thread_pool, num_tasks):
+    """ seconds between add_task and the moment a thread starts computing the task """
+    picked_up = Event()
+    pickup_time = []
+    compute_task = thread_pool.task_solver.compute_task
+
+    def timed_compute_task(task):
+        pickup_time.append(time.perf_counter())
+        result = compute_task(task)
+        picked_up.set()
+        return result
+    thread_pool.task_solver.compute_task = timed_compute_task
+
+    latencies = []
+    question = thread_pool.data.vocabularies['Question'][0]
+    for i in range(num_tasks):
+        picked_up.clear()
+        # different payloads => tasks are not coalesced
+        task = {'question': question, 'bench_id': i}
+        enqueue_time = time.perf_counter()
+        thread_pool.add_task(task, 'global_mean', thread_pool.job_registry.new_job())
+        picked_up.wait()
+        latencies.append(pickup_time[-1] - enqueue_time)
+    return sorted(latencies)
+
+def measure_mixed_latency(data, seconds_per_cost):
+    """
+    seconds between add_task and done for a burst of mean_by_category and state_mean jobs
+    return sorted latencies of the cheap (state_mean) jobs
+    """
+    os.environ['TP_SCHED_SECONDS_PER_COST'] = str(seconds_per_cost)
+    thread_pool = ThreadPool(data)
+    job_registry = thread_pool.job_registry
+    subscriber = job_registry.subscribe()
+    question = data.vocabularies['Question'][0]
+    state = data.decode('Location', data.get_locations(question)[0])
+    enqueue_time = {}
+    for i in range(NUM_MIXED_TASKS):
+        job_id = job_registry.new_job()
+        if i % 2 == 0:
+            task, request_type = {'question': question, 'bench_id': i}, 'mean_by_category'
+        else:
+            task, request_type = {'question': question, 'state': state, 'bench_id': i}, \
+                'state_mean'
+        enqueue_time[job_id] = (time.perf_counter(), request_type)
+        thread_pool.add_task(task, request_type, job_id)
+
+    latencies = []
+    for _ in range(NUM_MIXED_TASKS):
+        job_id, _ = subscriber.get()
+        start, request_type = enqueue_time[job_id]
+        if request_type == 'state_mean':
+            latencies.append(time.perf_counter() - start)
+    thread_pool.shutdown()
+    return sorted(latencies)
+
+def measure_logging_latency(num_requests):
+    """
+    seconds taken by get_results requests (through the flask test client) for a done
+    mean_by_category job, with logging off, through the queue and written by the request thread
+    return {mode: sorted latencies}
+    """
+    client = webserver.test_client()
+    question = webserver.data_ingestor.vocabularies['Question'][0]
+    job_id = client.post('/api/mean_by_category', json={'question': question}).get_json()['job_id']
+    path = f'/api/get_results/{job_id}?wait=5'
+    client.get(path)
+
+    disabled = logger.disabled
+    modes = {}
+    for mode in ('off', 'queue', 'sync'):
+        logger.disabled = mode == 'off'
+        if mode == 'sync':
+            # file handler called by the request thread, as without the queue
+            logger.removeHandler(queue_handler)
+            logger.addHandler(handler)
+        latencies = []
+        for _ in range(num_requests):
+            start = time.perf_counter()
+            client.get(path)
+            latencies.append(time.perf_counter() - start)
+        if mode == 'sync':
+            logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+        modes[mode] = sorted(latencies)
+    logger.disabled = disabled
+    return modes
+
+def main():
+    """ run benchmark on the given csv file (default: unittests data) """
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else './unittests/test_data.csv'
+    os.makedirs('results', exist_ok=True)
+    thread_pool = ThreadPool(DataIngestor(csv_path))
+    print(f"threads: {thread_pool.num_threads}")
+    print(f"idle cpu: {measure_idle_cpu(IDLE_SECONDS):.1f}% of one core")
+
+    latencies = measure_pickup_latency(thread_pool, NUM_TASKS)
+    print(f"pickup latency over {NUM_TASKS} tasks: "
+          f"p50 {latencies[len(latencies) // 2] * 1e6:.0f} us, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us, "
+          f"max {latencies[-1] * 1e6:.0f} us")
+
+    start = time.perf_counter()
+    thread_pool.shutdown()
+    print(f"shutdown: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    for name, seconds_per_cost in (('fifo', 0), ('cost', 0.0001)):
+        latencies = measure_mixed_latency(thread_pool.data, seconds_per_cost)
+        print(f"state_mean latency among mean_by_category jobs ({name} order): "
+              f"p50 {latencies[len(latencies) // 2] * 1e3:.1f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.1f} ms")
+
+    for mode, latencies in measure_logging_latency(NUM_REQUESTS).items():
+        print(f"get_results latency over {NUM_REQUESTS} requests (logging {mode}): "
+              f"p50 {latencies[len(latencies) // 2] * 1e6:.0f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us")
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        # the server imported with the app package has its own threads
+        webserver.tasks_runner.shutdown()
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+from app import webserver
+from app.asgi import application, JobNotifier
+from app.job_registry import JobRegistry
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        self.client = webserver.test_client()
+        self.q = 'Percent of adults who engage in no leisure-time physical activity'
+
+    def call(self, method, path, body=b'', query_string=b''):
+        """ send one request to the ASGI application, return (status, body) """
+        messages = []
+        requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            return requests.pop(0) if requests else {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+                 'headers': [(b'content-type', b'application/json')], 'http_version': '1.1'}
+        asyncio.run(application(scope, receive, send))
+        return messages[0]['status'], b''.join(message.get('body', b'')
+                                               for message in messages[1:])
+
+    def test_submit_and_wait_for_result(self):
+        status, body = self.call('POST', '/api/states_mean', json.dumps({'question': self.q}).encode())
+        self.assertEqual(status, 200)
+        job_id = json.loads(body)['job_id']
+        status, body = self.call('GET', '/api/get_results/' + job_id, query_string=b'wait=5')
+        self.assertEqual(json.loads(body)['status'], 'done')
+        # same job ids and same responses as the flask webserver
+        self.assertEqual(body, self.client.get('/api/get_results/' + job_id).get_data())
+
+    def test_unknown_state_is_rejected(self):
+        _, body = self.call('POST', '/api/state_mean',
+                            json.dumps({'question': self.q, 'state': 'Nowhere'}).encode())
+        self.assertEqual(json.loads(body), {'status': 'error', 'reason': 'Unknown state'})
+
+    def test_low_priority_request_is_shed(self):
+        limiter = webserver.tasks_runner.limiter
+        with mock.patch.object(limiter, 'soft_limit', 0):
+            status, body = self.call('POST', '/api/mean_by_category',
+                                     json.dumps({'question': self.q}).encode())
+            self.assertEqual(status, 429)
+            self.assertEqual(json.loads(body)['retry_after'], limiter.retry_after)
+            response = self.client.post('/api/mean_by_category', json={'question': self.q})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], str(limiter.retry_after))
+        self.assertEqual(self.client.get('/api/queue_stats').json['data']['shed'],
+                         {'mean_by_category': 2})
+
+    def test_invalid_job_id(self):
+        _, body = self.call('GET', '/api/get_results/job_id_0')
+        self.assertEqual(json.loads(body), {'status': 'error', 'reason': 'Invalid job_id'})
+
+    def test_other_requests_answered_by_flask(self):
+        status, body = self.call('GET', '/api/num_jobs')
+        self.assertEqual(status, 200)
+        self.assertIn('jobs_running', json.loads(body))
+
+    def test_events(self):
+        _, body = self.call('POST', '/api/global_mean', json.dumps({'question': self.q}).encode())
+        job_id = json.loads(body)['job_id']
+        # stream ends when the job is reported
+        _, body = self.call('GET', '/api/events', query_string=b'results=1&job_ids=' + job_id.encode())
+        event = json.loads(body.decode().split('data: ')[1])
+        self.assertEqual(event['job_id'], job_id)
+        self.assertEqual(event['status'], 'done')
+
+    def test_lifespan_shutdown_closes_notifier(self):
+        self.call('GET', '/api/num_jobs')
+        notifier = application.notifier
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertIsNone(application.notifier)
+        self.assertNotIn(notifier.subscriber, webserver.tasks_runner.job_registry.subscribers)
+
+    def test_closed_event_loop_stops_forwarding(self):
+        job_registry = JobRegistry()
+        loop = asyncio.new_event_loop()
+        loop.close()
+        notifier = JobNotifier(loop, job_registry)
+        # the thread can't hand the job to the closed loop => it stops, without an error
+        job_registry.set_status(job_registry.new_job(), 'done')
+        notifier.thread.join(timeout=5)
+        self.assertFalse(notifier.thread.is_alive())
+        self.assertEqual(job_registry.subscribers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
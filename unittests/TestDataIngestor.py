@@ -0,0 +1,183 @@
+import copy
+import csv
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from app import data_ingestor
+from app.data_ingestor import CODED_COLUMNS, DataIngestor, append_csv_file
+from app.shared_data import attach_columns, release_chunks, share_columns
+from app.task_solver import TaskSolver
+
+class TestDataIngestor(unittest.TestCase):
+    def setUp(self):
+        # quoted fields with commas and newlines, so byte ranges must not cut them
+        header = ['Data_Value', 'GeoLocation', *CODED_COLUMNS.values()]
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for i in range(300):
+                row = {column: '%s %d' % (column, i % (3 + len(column) % 5)) for column in header}
+                row['Data_Value'] = str(i * 0.1)
+                row['GeoLocation'] = '(%d.5,\n -98.%d)' % (i, i)
+                row['Stratification1'] = 'Age "%d",\n or more' % (i % 4)
+                writer.writerow([row[column] for column in header])
+
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.remove(self.csv_path)
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_same_as_dict_reader(self):
+        data = DataIngestor(self.csv_path, num_workers=1)
+        with open(self.csv_path, mode='r', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(data.num_rows, len(rows))
+        self.assertEqual(data.get_column('Data_Value').tolist(),
+                         [float(row['Data_Value']) for row in rows])
+        for column, csv_column in CODED_COLUMNS.items():
+            self.assertEqual([data.decode(column, code) for code in data.get_column(column)],
+                             [row[csv_column] for row in rows])
+
+    def test_value_that_is_not_a_number(self):
+        with open(self.csv_path, encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+        # row 5 is about 'Question 5'
+        rows[6][0] = ''
+        with open(self.csv_path, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(rows)
+        data = DataIngestor(self.csv_path, num_workers=1)
+        self.assertEqual(data.num_rows, 300)
+        self.assertTrue(np.isnan(data.get_column('Data_Value')[5]))
+        # only the jobs that read the value fail
+        task_solver = TaskSolver(data)
+        with self.assertRaises(ValueError):
+            task_solver.global_mean('Question 5')
+        with self.assertRaises(ValueError):
+            task_solver.query({'Question': 'Question 5'}, [], 'mean')
+        self.assertEqual(task_solver.query({'Question': 'Question 5'}, [], 'count'),
+                         {'count': 50})
+        self.assertIn('global_mean', task_solver.global_mean('Question 1'))
+
+    def test_parallel_same_as_sequential(self):
+        data = DataIngestor(self.csv_path, num_workers=1)
+        with mock.patch.object(data_ingestor, 'MIN_PART_BYTES', 1000):
+            parallel_data = DataIngestor(self.csv_path, num_workers=4)
+        self.assertEqual(parallel_data.ingest_stats['workers'], 4)
+        self.assertTrue(np.array_equal(parallel_data.get_column('Data_Value'),
+                                       data.get_column('Data_Value')))
+        self.assertEqual(parallel_data.vocabularies, data.vocabularies)
+        for column in CODED_COLUMNS:
+            self.assertTrue(np.array_equal(parallel_data.get_column(column),
+                                           data.get_column(column)))
+
+    def test_snapshot(self):
+        snapshot_path = os.path.join(self.snapshot_dir, 'data.snapshot')
+        data = DataIngestor(self.csv_path, num_workers=1, snapshot_path=snapshot_path)
+        self.assertEqual(data.ingest_stats['source'], 'csv')
+        self.assertTrue(os.path.exists(snapshot_path))
+
+        loaded_data = DataIngestor(self.csv_path, num_workers=1, snapshot_path=snapshot_path)
+        self.assertEqual(loaded_data.ingest_stats['source'], 'snapshot')
+        self.assertTrue(np.array_equal(loaded_data.get_column('Data_Value'),
+                                       data.get_column('Data_Value')))
+        self.assertEqual(loaded_data.vocabularies, data.vocabularies)
+        self.assertEqual(loaded_data.aggregates, data.aggregates)
+        # read-only view of the mapped file, shared with other processes instead of copied
+        self.assertFalse(loaded_data.get_column('Data_Value').flags.writeable)
+        description, blocks = share_columns(loaded_data)
+        self.assertEqual(blocks, [])
+        attached_data, _ = attach_columns(description)
+        self.assertEqual(attached_data.get_aggregate('Question 1', 'LocationDesc 1'),
+                         data.get_aggregate('Question 1', 'LocationDesc 1'))
+
+        # csv file changed (modification time is part of the key) => snapshot is rebuilt
+        os.utime(self.csv_path, ns=(0, 0))
+        data = DataIngestor(self.csv_path, num_workers=1, snapshot_path=snapshot_path)
+        self.assertEqual(data.ingest_stats['source'], 'csv')
+
+    def test_append_same_as_full_load(self):
+        data = DataIngestor(self.csv_path, num_workers=1)
+        with open(self.csv_path, encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+        texts = []
+        for part in (rows[:1], rows[1:100], rows[100:]):
+            text = io.StringIO()
+            csv.writer(text).writerows(part)
+            texts.append(text.getvalue())
+        with open(self.csv_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(texts[0] + texts[1])
+        old_data = DataIngestor(self.csv_path, num_workers=1)
+        old_aggregates = copy.deepcopy(old_data.aggregates)
+        new_data = old_data.append_csv(texts[0] + texts[2])
+        self.assertEqual(new_data.version, old_data.version + 1)
+        self.assertEqual(new_data.vocabularies, data.vocabularies)
+        self.assertEqual(new_data.aggregates, data.aggregates)
+        self.assertEqual(new_data.ingest_stats['source'], 'append')
+        self.assertEqual(new_data.ingest_stats['rows'], len(rows) - 100)
+        self.assertEqual(old_data.ingest_stats['source'], 'csv')
+        # older version is not changed, jobs still using it see the same data
+        self.assertEqual(old_data.aggregates, old_aggregates)
+        self.assertEqual(old_data.num_rows, 99)
+        with self.assertRaises(ValueError):
+            old_data.append_csv('Question,Location\nq,l\n')
+
+    def get_append_texts(self, num_texts, rows_per_text):
+        """ csv texts (header line first) with rows of the test file, in reversed column order """
+        with open(self.csv_path, encoding='utf-8', newline='') as f:
+            rows = [row[::-1] for row in csv.reader(f)]
+        texts = []
+        for i in range(num_texts):
+            text = io.StringIO()
+            csv.writer(text).writerows([rows[0]] + rows[1 + i * rows_per_text:
+                                                        1 + (i + 1) * rows_per_text])
+            texts.append(text.getvalue())
+        return texts
+
+    def test_appends_share_chunks(self):
+        data = DataIngestor(self.csv_path, num_workers=1)
+        new_data = data
+        for text in self.get_append_texts(8, 10):
+            new_data = new_data.append_csv(text)
+            append_csv_file(self.csv_path, text)
+        # rows of the first version are not copied, the appended ones are in a few chunks
+        self.assertIs(new_data.chunks[0], data.chunks[0])
+        self.assertLessEqual(len(new_data.chunks), 4)
+        self.assertEqual(new_data.num_rows, 380)
+        # same as reading the csv file the rows were appended to
+        full_data = DataIngestor(self.csv_path, num_workers=1)
+        self.assertEqual(new_data.aggregates, full_data.aggregates)
+        self.assertEqual(new_data.vocabularies, full_data.vocabularies)
+        for column in ['Data_Value', *CODED_COLUMNS]:
+            self.assertTrue(np.array_equal(new_data.get_column(column),
+                                           full_data.get_column(column)))
+        self.assertTrue(np.array_equal(new_data.get_column('Question', 295),
+                                       full_data.get_column('Question')[295:]))
+
+    def test_attach_appended_rows(self):
+        data = DataIngestor(self.csv_path, num_workers=1)
+        description, shared_chunks = share_columns(data)
+        attached = attach_columns(description)
+        new_data = data
+        for text in self.get_append_texts(3, 20):
+            new_data = new_data.append_csv(text)
+            new_description, new_shared_chunks = share_columns(new_data, shared_chunks)
+            # chunks already shared are not copied again
+            self.assertIs(new_shared_chunks[0][2], shared_chunks[0][2])
+            # only the new rows are grouped, aggregates are not built again
+            with mock.patch.object(DataIngestor, 'build_aggregates', side_effect=AssertionError):
+                new_attached = attach_columns(new_description, (attached[0], description))
+            self.assertEqual(new_attached[0].aggregates, new_data.aggregates)
+            self.assertEqual(new_attached[0].version, new_data.version)
+            release_chunks(shared_chunks, keep=new_shared_chunks, unlink=True)
+            attached, description, shared_chunks = new_attached, new_description, new_shared_chunks
+        release_chunks(shared_chunks, unlink=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
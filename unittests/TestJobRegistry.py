@@ -0,0 +1,79 @@
+import time
+import unittest
+from threading import Thread, Timer
+from app.job_registry import JobRegistry
+
+class TestJobRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = JobRegistry()
+
+    def test_new_jobs(self):
+        self.assertEqual(self.registry.new_job(), 'job_id_1')
+        self.assertEqual(self.registry.new_job(), 'job_id_2')
+        self.assertTrue(self.registry.is_valid('job_id_2'))
+        self.assertFalse(self.registry.is_valid('job_id_3'))
+        self.assertEqual(self.registry.get_status('job_id_1'), 'running')
+
+    def test_counters(self):
+        job1 = self.registry.new_job()
+        job2 = self.registry.new_job()
+        self.registry.new_job()
+        self.registry.set_status(job1, 'done')
+        self.registry.set_status(job2, 'failed', 'Unknown question')
+        self.assertEqual(self.registry.get_counts(), {'running': 1, 'done': 1, 'failed': 1})
+        self.assertEqual(self.registry.get_reason(job2), 'Unknown question')
+        self.assertEqual(self.registry.get_jobs(), [{'job_id_1': 'done'}, {'job_id_2': 'failed'},
+                                                    {'job_id_3': 'running'}])
+
+    def test_concurrent_ids_are_unique(self):
+        job_ids = []
+        def allocate():
+            for _ in range(1000):
+                job_ids.append(self.registry.new_job())
+        threads = [Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(job_ids)), 4000)
+        self.assertEqual(self.registry.get_counts()['running'], 4000)
+
+    def test_wait_job(self):
+        job_id = self.registry.new_job()
+        # nobody marks the job => wait until timeout
+        start = time.monotonic()
+        self.assertEqual(self.registry.wait_job(job_id, 0.05), 'running')
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        # woken up as soon as the job is done
+        Timer(0.05, self.registry.set_status, (job_id, 'done')).start()
+        start = time.monotonic()
+        self.assertEqual(self.registry.wait_job(job_id, 5), 'done')
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_subscribers_get_finished_jobs(self):
+        job1 = self.registry.new_job()
+        job2 = self.registry.new_job()
+        subscriber = self.registry.subscribe()
+        self.registry.set_status(job2, 'done')
+        self.registry.set_status(job1, 'failed', 'Unknown state')
+        self.assertEqual(subscriber.get(timeout=1), (job2, 'done'))
+        self.assertEqual(subscriber.get(timeout=1), (job1, 'failed'))
+        self.registry.unsubscribe(subscriber)
+        self.assertEqual(self.registry.subscribers, [])
+
+    def test_slow_subscriber_is_dropped(self):
+        subscriber = self.registry.subscribe(maxsize=2)
+        job_ids = [self.registry.new_job() for _ in range(3)]
+        for job_id in job_ids:
+            self.registry.set_status(job_id, 'done')
+        self.assertEqual(self.registry.get_dropped_subscribers(), 1)
+        self.assertEqual(self.registry.subscribers, [])
+        # events queued before it was dropped are still read, then the subscriber is closed
+        self.assertEqual(subscriber.get(timeout=1), (job_ids[0], 'done'))
+        self.assertEqual(subscriber.get(timeout=1), (job_ids[1], 'done'))
+        self.assertIsNone(subscriber.get(timeout=1))
+        self.registry.unsubscribe(subscriber)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import logging
+import unittest
+from queue import Full
+from unittest import mock
+from app import logging as app_logging
+from app.logging import BatchQueue, Payload, PayloadSampler
+
+class TestLogging(unittest.TestCase):
+    def make_record(self, *args):
+        return logging.LogRecord('app.logging', logging.INFO, __file__, 1, 'message %s', args, None)
+
+    def test_payload_is_truncated(self):
+        with mock.patch.object(app_logging, 'PAYLOAD_MAX_CHARS', 20):
+            text = str(Payload({'data': list(range(10000))}))
+        self.assertLessEqual(len(text), 23)
+        self.assertTrue(text.endswith('...'))
+        self.assertEqual(str(Payload({'question': 'q'})), "{'question': 'q'}")
+
+    def test_sampling(self):
+        sampler = PayloadSampler()
+        with mock.patch.object(app_logging, 'PAYLOAD_SAMPLE_RATE', 0):
+            self.assertFalse(sampler.filter(self.make_record(Payload([1, 2]))))
+            # messages without payload are always logged
+            self.assertTrue(sampler.filter(self.make_record('job_id_1')))
+        self.assertTrue(sampler.filter(self.make_record(Payload([1, 2]))))
+
+    def test_batch_queue(self):
+        log_queue = BatchQueue(2)
+        log_queue.put_nowait('first')
+        log_queue.put_nowait('second')
+        with self.assertRaises(Full):
+            log_queue.put_nowait('third')
+        self.assertEqual([log_queue.get(), log_queue.get()], ['first', 'second'])
+
+    def test_records_only_go_through_the_queue(self):
+        self.assertFalse(app_logging.logger.propagate)
+        self.assertEqual(app_logging.logger.handlers, [app_logging.queue_handler])
+
+
+if __name__ == '__main__':
+    unittest.main()
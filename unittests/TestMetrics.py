@@ -0,0 +1,49 @@
+import unittest
+from app import webserver
+from app.metrics import Metrics
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counters_and_gauges(self):
+        labels = (('request_type', 'best5'), ('status', 'done'))
+        self.metrics.add('asc_jobs_total', labels)
+        self.metrics.add('asc_jobs_total', labels, 2)
+        self.assertEqual(self.metrics.get_value('asc_jobs_total', labels), 3)
+        text = self.metrics.render([('asc_queue_depth', (), 7)])
+        self.assertIn('# TYPE asc_jobs_total counter\n', text)
+        self.assertIn('asc_jobs_total{request_type="best5",status="done"} 3\n', text)
+        self.assertIn('asc_queue_depth 7\n', text)
+
+    def test_histogram(self):
+        for value in (0.00005, 0.003, 0.003, 100):
+            self.metrics.observe('asc_solve_seconds', value)
+        text = self.metrics.render()
+        self.assertIn('# TYPE asc_solve_seconds histogram\n', text)
+        # buckets are cumulative
+        self.assertIn('asc_solve_seconds_bucket{le="0.0001"} 1\n', text)
+        self.assertIn('asc_solve_seconds_bucket{le="0.005"} 3\n', text)
+        self.assertIn('asc_solve_seconds_bucket{le="30"} 3\n', text)
+        self.assertIn('asc_solve_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('asc_solve_seconds_count 4\n', text)
+
+    def test_metrics_endpoint(self):
+        client = webserver.test_client()
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        job_id = client.post('/api/global_mean', json={'question': q}).json['job_id']
+        client.get(f'/api/get_results/{job_id}?wait=5')
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('asc_requests_total{request_type="global_mean",outcome="queued"}', text)
+        self.assertIn('asc_queue_wait_seconds_count{request_type="global_mean"}', text)
+        self.assertIn('asc_get_results_seconds_count', text)
+        self.assertIn('asc_workers_idle', text)
+        # every exported metric has a type and a help text
+        self.assertNotIn('untyped', text)
+        self.assertIn('# TYPE asc_events_dropped_subscribers_total counter\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from app.result_cache import ResultCache
+from app.task_solver import TaskSolver
+from app.data_ingestor import DataIngestor
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(max_entries=2, max_bytes=1024)
+        self.q1 = 'Percent of adults aged 18 years and older who have an overweight classification'
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(('state_mean', self.q1, 'Utah'), 1))
+        self.cache.put(('state_mean', self.q1, 'Utah'), {'Utah': 36.9}, 1)
+        self.assertEqual(self.cache.get(('state_mean', self.q1, 'Utah'), 1), {'Utah': 36.9})
+        stats = self.cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', {'a': 1}, 1)
+        self.cache.put('b', {'b': 2}, 1)
+        # 'a' becomes most recently used => 'b' is evicted
+        self.cache.get('a', 1)
+        self.cache.put('c', {'c': 3}, 1)
+        self.assertIsNone(self.cache.get('b', 1))
+        self.assertEqual(self.cache.get('a', 1), {'a': 1})
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = ResultCache(max_entries=10, max_bytes=30)
+        cache.put('a', {'a': 'x' * 10}, 1)
+        cache.put('b', {'b': 'y' * 10}, 1)
+        self.assertIsNone(cache.get('a', 1))
+        self.assertLessEqual(cache.get_stats()['bytes'], 30)
+        # result bigger than the whole cache is not stored
+        cache.put('c', {'c': 'z' * 100}, 1)
+        self.assertIsNone(cache.get('c', 1))
+
+    def test_new_data_version_invalidates(self):
+        self.cache.put('a', {'a': 1}, 1)
+        self.assertIsNone(self.cache.get('a', 2))
+        self.assertEqual(self.cache.get_stats()['entries'], 0)
+
+    def test_older_data_version_is_ignored(self):
+        self.cache.put('a', {'a': 2}, 2)
+        # job still solved from version 1 doesn't drop results of version 2
+        self.cache.put('b', {'b': 1}, 1)
+        self.assertIsNone(self.cache.get('a', 1))
+        self.assertEqual(self.cache.get('a', 2), {'a': 2})
+        self.assertIsNone(self.cache.get('b', 2))
+
+    def test_task_solver_uses_cache(self):
+        data = DataIngestor("./unittests/test_data.csv")
+        task_solver = TaskSolver(data, self.cache)
+        task = {'request_type': 'global_mean', 'question': self.q1}
+        first = task_solver.solve_task(task)
+        self.assertIs(task_solver.solve_task(task), first)
+        data.version += 1
+        self.assertIsNot(task_solver.solve_task(task), first)
+        self.assertEqual(task_solver.solve_task(task), first)
+
+    def test_is_cached(self):
+        data = DataIngestor("./unittests/test_data.csv")
+        task_solver = TaskSolver(data, self.cache)
+        task = {'request_type': 'states_mean', 'question': self.q1}
+        self.assertFalse(task_solver.is_cached(task))
+        task_solver.solve_task(task)
+        self.assertTrue(task_solver.is_cached(task))
+        # checking doesn't count as a hit
+        self.assertEqual(self.cache.get_stats()['hits'], 0)
+        data.version += 1
+        self.assertFalse(task_solver.is_cached(task))
+
+    def test_key_has_only_used_fields(self):
+        data = DataIngestor("./unittests/test_data.csv")
+        task_solver = TaskSolver(data, self.cache)
+        task_solver.solve_task({'request_type': 'states_mean', 'question': self.q1})
+        # state and unknown fields are not used by states_mean => same entry
+        self.assertTrue(task_solver.is_cached({'request_type': 'states_mean', 'question': self.q1,
+                                               'state': 'Utah', 'extra': [1]}))
+        task_solver.solve_task({'request_type': 'query', 'filters': {'Question': self.q1}})
+        self.assertTrue(task_solver.is_cached({'request_type': 'query', 'group_by': [],
+                                               'filters': {'Question': self.q1},
+                                               'aggregate': 'mean'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from app.result_store import FileResultStore, MemoryResultStore
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.result = {'status': 'done', 'data': {'Utah': 36.9}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_store(self):
+        store = FileResultStore(self.directory, ttl=60)
+        store.put('job_id_1', self.result)
+        self.assertTrue(os.path.exists(os.path.join(store.directory, 'job_id_1.txt')))
+        self.assertEqual(store.get('job_id_1'), self.result)
+        self.assertIsNone(store.get('job_id_2'))
+
+    def test_memory_store_spills_oldest(self):
+        store = MemoryResultStore(self.directory, ttl=60, max_entries=1, spill=True)
+        store.put('job_id_1', self.result)
+        self.assertEqual(os.listdir(store.directory), [])
+        store.put('job_id_2', {'status': 'done', 'data': {}})
+        self.assertEqual(os.listdir(store.directory), ['job_id_1.txt'])
+        self.assertEqual(store.get('job_id_1'), self.result)
+        self.assertEqual(store.get_stats()['spilled'], 1)
+
+    def test_memory_store_drops_without_spill(self):
+        store = MemoryResultStore(self.directory, ttl=60, max_entries=1, spill=False)
+        store.put('job_id_1', self.result)
+        store.put('job_id_2', self.result)
+        self.assertIsNone(store.get('job_id_1'))
+        self.assertEqual(os.listdir(store.directory), [])
+
+    def test_expired_results_are_removed(self):
+        store = MemoryResultStore(self.directory, ttl=0.05, max_entries=1, spill=True)
+        store.put('job_id_1', self.result)
+        store.put('job_id_2', self.result)
+        time.sleep(0.1)
+        self.assertIsNone(store.get('job_id_1'))
+        self.assertIsNone(store.get('job_id_2'))
+        self.assertEqual(os.listdir(store.directory), [])
+        self.assertEqual(store.get_stats()['expired'], 2)
+
+    def test_processes_dont_share_results(self):
+        store = FileResultStore(self.directory, ttl=60)
+        store.put('job_id_1', self.result)
+        # another server process, same directory, same job ids
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            other_store = FileResultStore(self.directory, ttl=60)
+        self.assertIsNone(other_store.get('job_id_1'))
+        other_store.put('job_id_1', {'status': 'done', 'data': {}})
+        self.assertEqual(store.get('job_id_1'), self.result)
+
+
+if __name__ == '__main__':
+    unittest.main()
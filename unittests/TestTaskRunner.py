@@ -0,0 +1,227 @@
+import os
+import time
+import unittest
+from functools import partial
+from unittest import mock
+from app.task_runner import JobCoalescer, ProcessExecutor, QueueLimiter, ThreadPool, \
+    get_coalesce_key
+from app.result_cache import ResultCache
+from app.task_solver import TaskSolver
+from app.data_ingestor import DataIngestor
+
+class TestJobCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = JobCoalescer()
+        self.q1 = 'Percent of adults aged 18 years and older who have an overweight classification'
+
+    def test_identical_jobs_share_key(self):
+        task1 = {'question': self.q1, 'state': 'Utah', 'request_type': 'state_mean',
+                 'job_id': 'job_id_1'}
+        task2 = {'state': 'Utah', 'question': self.q1, 'request_type': 'state_mean',
+                 'job_id': 'job_id_2'}
+        task3 = dict(task1, request_type='state_diff_from_mean')
+        self.assertEqual(get_coalesce_key(task1), get_coalesce_key(task2))
+        self.assertNotEqual(get_coalesce_key(task1), get_coalesce_key(task3))
+
+    def test_attach_and_detach(self):
+        self.assertFalse(self.coalescer.attach('key', 'job_id_1'))
+        self.assertTrue(self.coalescer.attach('key', 'job_id_2'))
+        self.assertFalse(self.coalescer.attach('other', 'job_id_3'))
+        self.assertEqual(self.coalescer.detach('key'), ['job_id_1', 'job_id_2'])
+        # computation finished => next identical job starts a new one
+        self.assertFalse(self.coalescer.attach('key', 'job_id_4'))
+        self.assertEqual(self.coalescer.get_stats(),
+                         {'computations_saved': 1, 'in_flight': 2})
+
+
+class TestQueueLimiter(unittest.TestCase):
+    def test_limits(self):
+        with mock.patch.dict(os.environ, {'TP_MAX_QUEUE': '10', 'TP_QUEUE_SOFT_LIMIT': '5',
+                                          'TP_LOW_PRIORITY': 'query'}):
+            limiter = QueueLimiter()
+        self.assertIsNone(limiter.admit('query', 4))
+        # above soft limit only low priority jobs are shed
+        self.assertIsNotNone(limiter.admit('query', 5))
+        self.assertIsNone(limiter.admit('best5', 9))
+        self.assertIsNotNone(limiter.admit('best5', 10))
+        # a batch is admitted only if all its queries fit
+        self.assertIsNotNone(limiter.admit('batch', 8, 3))
+        self.assertIsNone(limiter.admit('batch', 8, 2))
+        stats = limiter.get_stats(3)
+        self.assertEqual((stats['depth'], stats['rejected'], stats['shed']),
+                         (3, {'best5': 1, 'batch': 1}, {'query': 1}))
+
+    def test_unbounded(self):
+        with mock.patch.dict(os.environ, {'TP_MAX_QUEUE': '0'}):
+            limiter = QueueLimiter()
+        self.assertIsNone(limiter.admit('query', 10 ** 6))
+
+
+class TestProcessExecutor(unittest.TestCase):
+    def setUp(self):
+        self.data = DataIngestor("./unittests/test_data.csv")
+        self.executor = ProcessExecutor(self.data, 1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_same_results_as_thread(self):
+        task_solver = TaskSolver(self.data)
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        for request_type in ['states_mean', 'best5', 'global_mean', 'mean_by_category']:
+            task = {'request_type': request_type, 'question': q}
+            self.assertEqual(self.executor.compute_task(task, task_solver),
+                             task_solver.compute_task(task))
+        task = {'request_type': 'state_mean_by_category', 'question': q, 'state': 'Wyoming'}
+        self.assertEqual(self.executor.compute_task(task, task_solver),
+                         task_solver.compute_task(task))
+
+    def test_batch_same_results_as_thread(self):
+        task_solver = TaskSolver(self.data)
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        tasks = [{'request_type': 'best5', 'question': q},
+                 {'request_type': 'state_mean', 'question': q, 'state': 'Wyoming'},
+                 {'request_type': 'state_mean', 'question': q, 'state': 'Nowhere'}]
+        results = self.executor.compute_batch(tasks, task_solver)
+        expected = task_solver.compute_batch(tasks)
+        self.assertEqual(results[:2], expected[:2])
+        # a failed query is returned as its exception
+        self.assertIsInstance(results[2], type(expected[2]))
+
+    def test_batch_uses_cache(self):
+        task_solver = TaskSolver(self.data, ResultCache(max_entries=16, max_bytes=1 << 20))
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        tasks = [{'request_type': 'best5', 'question': q},
+                 {'request_type': 'global_mean', 'question': q}]
+        task_solver.solve_task(tasks[0])
+        compute_batch = mock.Mock(side_effect=partial(self.executor.compute_batch,
+                                                      task_solver=task_solver))
+        results = task_solver.solve_batch(tasks, compute_batch)
+        self.assertEqual(results, [task_solver.compute_task(task) for task in tasks])
+        # only the query that was not cached reached the worker, its result is cached now
+        compute_batch.assert_called_once_with([tasks[1]])
+        self.assertTrue(task_solver.is_cached(tasks[1]))
+
+    def test_refresh_with_new_data(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        task = {'request_type': 'states_mean', 'question': q}
+        with open("./unittests/test_data.csv", encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        new_data = self.data.append_csv('\n'.join([lines[0]] + lines[1:5]))
+        new_task_solver = TaskSolver(new_data)
+        self.executor.refresh(new_data)
+        self.assertEqual(self.executor.compute_task(task, new_task_solver),
+                         new_task_solver.compute_task(task))
+        # job started before the refresh is still solved from its version of the data
+        old_task_solver = TaskSolver(self.data)
+        self.assertEqual(self.executor.compute_task(task, old_task_solver),
+                         old_task_solver.compute_task(task))
+
+    def test_refresh_keeps_the_same_workers(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        task = {'request_type': 'global_mean', 'question': q}
+        with open("./unittests/test_data.csv", encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        pool = self.executor.pool
+        data = self.data
+        for i in range(3):
+            data = data.append_csv('\n'.join([lines[0]] + lines[1 + i:3 + i]))
+            self.executor.refresh(data)
+            task_solver = TaskSolver(data)
+            self.assertEqual(self.executor.compute_task(task, task_solver),
+                             task_solver.compute_task(task))
+        # workers get the new data, they are not forked again
+        self.assertIs(self.executor.pool, pool)
+
+    def restart_worker(self):
+        """ make the worker process exit during a task, wait until the pool starts another """
+        worker = self.executor.pool._pool[0]
+        self.executor.pool.apply_async(os._exit, (1,))
+        worker.join()
+        deadline = time.monotonic() + 10
+        while worker in self.executor.pool._pool and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def test_restarted_worker_uses_current_data(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        task = {'request_type': 'states_mean', 'question': q}
+        with open("./unittests/test_data.csv", encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        # read again => the first chunks are not shared anymore after the refresh
+        new_data = DataIngestor("./unittests/test_data.csv").append_csv(
+            '\n'.join([lines[0]] + lines[1:5]))
+        new_data.version = self.data.version + 1
+        self.executor.refresh(new_data)
+        self.restart_worker()
+        task_solver = TaskSolver(new_data)
+        self.assertEqual(self.executor.compute_task(task, task_solver),
+                         task_solver.compute_task(task))
+
+    def test_worker_without_data_fails_tasks(self):
+        # a worker that can't attach to the data stays up, its tasks fail with the reason
+        with mock.patch('app.task_runner.attach_columns', side_effect=RuntimeError('gone')):
+            self.restart_worker()
+        task = {'request_type': 'global_mean', 'question': 'q'}
+        with self.assertRaisesRegex(RuntimeError, 'gone'):
+            self.executor.compute_task(task, TaskSolver(self.data))
+
+
+class TestThreadPool(unittest.TestCase):
+    def setUp(self):
+        self.thread_pool = ThreadPool(DataIngestor("./unittests/test_data.csv"))
+
+    def tearDown(self):
+        self.thread_pool.shutdown()
+
+    def test_failed_job_does_not_hang(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        job_registry = self.thread_pool.job_registry
+        # not validated (as in routes.py), so it fails in the worker
+        job_id = job_registry.new_job()
+        self.thread_pool.add_task({'question': q, 'state': 'Nowhere'}, 'state_mean', job_id)
+        self.assertEqual(job_registry.wait_job(job_id, 5), 'failed')
+        self.assertTrue(job_registry.get_reason(job_id).startswith('ZeroDivisionError'))
+        # worker is still alive
+        job_id = job_registry.new_job()
+        self.thread_pool.add_task({'question': q, 'state': 'Wyoming'}, 'state_mean', job_id)
+        self.assertEqual(job_registry.wait_job(job_id, 5), 'done')
+
+    def test_failed_batch_does_not_hang(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        job_registry = self.thread_pool.job_registry
+        tasks = [{'request_type': 'global_mean', 'question': q},
+                 {'request_type': 'state_mean', 'question': q, 'state': 'Wyoming'}]
+        job_ids = [job_registry.new_job() for _ in tasks]
+        with mock.patch.object(self.thread_pool.task_solver, 'compute_batch',
+                               side_effect=RuntimeError('Worker process died')):
+            self.thread_pool.add_batch(tasks, job_ids)
+            for job_id in job_ids:
+                self.assertEqual(job_registry.wait_job(job_id, 5), 'failed')
+                self.assertEqual(job_registry.get_reason(job_id),
+                                 'RuntimeError: Worker process died')
+        # workers are still alive
+        job_id = job_registry.new_job()
+        self.thread_pool.add_task({'question': q}, 'global_mean', job_id)
+        self.assertEqual(job_registry.wait_job(job_id, 5), 'done')
+
+    def test_failed_result_write_does_not_hang(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        job_registry = self.thread_pool.job_registry
+        with mock.patch.object(self.thread_pool.result_store, 'put',
+                               side_effect=OSError('No space left on device')):
+            # identical jobs (coalesced if the first one is still running) all fail
+            job_ids = [job_registry.new_job() for _ in range(2)]
+            for job_id in job_ids:
+                self.thread_pool.add_task({'question': q}, 'global_mean', job_id)
+            for job_id in job_ids:
+                self.assertEqual(job_registry.wait_job(job_id, 5), 'failed')
+                self.assertEqual(job_registry.get_reason(job_id),
+                                 'OSError: No space left on device')
+        # workers are still alive
+        job_id = job_registry.new_job()
+        self.thread_pool.add_task({'question': q}, 'global_mean', job_id)
+        self.assertEqual(job_registry.wait_job(job_id, 5), 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+from app.task_scheduler import TaskScheduler
+
+class TestTaskScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = TaskScheduler(seconds_per_cost=0.001, max_delay=1)
+
+    def get_all(self):
+        return [self.scheduler.get() for _ in range(self.scheduler.qsize())]
+
+    def test_cheap_tasks_first(self):
+        self.scheduler.put('mean_by_category', 500)
+        self.scheduler.put('states_mean', 50)
+        self.scheduler.put('state_mean', 2)
+        self.scheduler.put('state_diff_from_mean', 2)
+        self.assertEqual(self.get_all(), ['state_mean', 'state_diff_from_mean', 'states_mean',
+                                          'mean_by_category'])
+
+    def test_expensive_task_is_not_starved(self):
+        with mock.patch('app.task_scheduler.time.monotonic', side_effect=[0, 0.5, 2, 3]):
+            # delay is capped at max_delay => deadline 1
+            self.scheduler.put('query', 10 ** 6)
+            self.scheduler.put('state_mean', 2)
+            # added after the deadline of query
+            self.scheduler.put('best5', 2)
+            self.scheduler.put('state_mean', 2)
+        self.assertEqual(self.get_all(), ['state_mean', 'query', 'best5', 'state_mean'])
+
+    def test_fifo_without_cost(self):
+        scheduler = TaskScheduler(seconds_per_cost=0, max_delay=1)
+        for i, cost in enumerate([100, 1, 10]):
+            scheduler.put(i, cost)
+        self.assertEqual([scheduler.get() for _ in range(3)], [0, 1, 2])
+
+    def test_put_last(self):
+        self.scheduler.put_last(None)
+        self.scheduler.put('query', 10 ** 6)
+        self.assertEqual(self.get_all(), ['query', None])
+
+    def test_size_counts_jobs(self):
+        self.scheduler.put('batch', 10, size=5)
+        self.scheduler.put('best5', 2)
+        self.assertEqual(self.scheduler.qsize(), 6)
+        self.assertEqual(self.scheduler.get(), 'best5')
+        self.assertEqual(self.scheduler.qsize(), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+from unittest import mock
+from app import webserver
 from app.task_solver import TaskSolver
 from app.data_ingestor import DataIngestor
  
@@ -112,6 +114,186 @@ class TestWebserver(unittest.TestCase):
         self.assertAlmostEqual(task_res['Wyoming']["('Income', '$15,000 - $24,999')"], 29.3, delta=0.1)
         self.assertAlmostEqual(task_res['Wyoming']["('Race/Ethnicity', 'American Indian/Alaska Native')"], 24.0, delta=0.1)
 
+    def test_estimate_cost(self):
+        self.assertEqual(self.task_solver.estimate_cost({'request_type': 'states_mean',
+                                                         'question': self.q1}), 5)
+        self.assertEqual(self.task_solver.estimate_cost({'request_type': 'mean_by_category',
+                                                         'question': self.q1}), 5)
+        self.assertEqual(self.task_solver.estimate_cost({'request_type': 'state_mean',
+                                                         'question': self.q1,
+                                                         'state': self.state1}), 2)
+        self.assertEqual(self.task_solver.estimate_cost({'request_type': 'state_mean_by_category',
+                                                         'question': self.q2,
+                                                         'state': self.state2}), 2)
+
+    def test_solve_batch(self):
+        tasks = [{'request_type': 'best5', 'question': self.q1},
+                 {'request_type': 'diff_from_mean', 'question': self.q1},
+                 {'request_type': 'state_mean', 'question': self.q2, 'state': self.state2},
+                 {'request_type': 'global_mean', 'question': self.q1},
+                 {'request_type': 'state_mean', 'question': self.q2, 'state': 'Nowhere'}]
+        results = self.task_solver.solve_batch(tasks)
+        for task, result in zip(tasks[:4], results):
+            self.assertEqual(result, self.task_solver.solve_task(task))
+        self.assertIsInstance(results[4], ZeroDivisionError)
+
+    def test_query(self):
+        # same values as states_mean, grouped by a column the endpoints don't use
+        task_res = self.task_solver.query({'Question': self.q1}, ['Location'], 'mean')
+        self.assertEqual(task_res, dict(sorted(self.task_solver.states_mean(self.q1).items())))
+
+        task_res = self.task_solver.query({'Question': [self.q1, self.q2]}, ['YearStart'], 'count')
+        self.assertEqual(sum(task_res.values()), 9)
+
+        task_res = self.task_solver.query({'Location': 'Wyoming'}, [], 'max')
+        self.assertAlmostEqual(task_res['max'], 29.3, delta=0.1)
+
+        task_res = self.task_solver.query({'Question': self.q2},
+                                          ['Location', 'Stratification_Category'], 'min')
+        self.assertAlmostEqual(task_res["('Wyoming', 'Income')"], 29.3, delta=0.1)
+
+        self.assertIsNotNone(self.task_solver.check_query({'Unknown': 1}, [], 'mean'))
+        self.assertIsNotNone(self.task_solver.check_query({}, ['Gender'], 'median'))
+        self.assertIsNone(self.task_solver.check_query({'Gender': 'Male'}, ['Income'], 'sum'))
+        self.assertEqual(self.task_solver.check_query({}, [['Gender']], 'mean'),
+                         "Unknown column ['Gender']")
+        self.assertIsNotNone(self.task_solver.check_query({'Gender': {'a': 1}}, [], 'mean'))
+        self.assertIsNotNone(self.task_solver.check_query({'Gender': [None]}, [], 'mean'))
+        self.assertIsNone(self.task_solver.check_query({'YearStart': [2011, '2012']}, [], 'count'))
+        self.assertIsNotNone(self.task_solver.check_query({'YearStart': 2011.5}, [], 'count'))
+        self.assertIsNotNone(self.task_solver.check_query({'YearStart': True}, [], 'count'))
+        # integral numbers match the text of the csv file, whatever their json type
+        self.assertEqual(self.task_solver.query({'YearStart': 2011.0}, [], 'count'),
+                         self.task_solver.query({'YearStart': '2011'}, [], 'count'))
+
+    def test_check_task(self):
+        self.assertIsNone(self.task_solver.check_task({'question': self.q1}, 'best5'))
+        self.assertIsNone(self.task_solver.check_task({'question': self.q2, 'state': self.state2},
+                                                      'state_mean'))
+        self.assertEqual(self.task_solver.check_task({'question': 'Unknown'}, 'best5'),
+                         'Unknown question')
+        self.assertEqual(self.task_solver.check_task({'question': self.q2, 'state': 'Nowhere'},
+                                                     'state_mean'), 'Unknown state')
+        self.assertEqual(self.task_solver.check_task({'question': self.q2}, 'state_mean'),
+                         'Missing state')
+        self.assertEqual(self.task_solver.check_task(['question'], 'global_mean'),
+                         'Invalid request')
+        # state is checked even where it is not used
+        self.assertEqual(self.task_solver.check_task({'question': self.q1, 'state': ['x']},
+                                                     'best5'), 'Invalid state')
+        self.assertEqual(self.task_solver.check_task({'question': [self.q1]}, 'best5'),
+                         'Missing question')
+        self.assertEqual(self.task_solver.check_task({'filters': []}, 'query'),
+                         'filters must be an object and group_by a list')
+
+
+class TestBatchEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = webserver.test_client()
+
+    def test_empty_batch_is_rejected(self):
+        labels = (('request_type', 'batch'), ('outcome', 'queued'))
+        queued = webserver.tasks_runner.metrics.get_value('asc_requests_total', labels)
+        response = self.client.post('/api/batch', json={'queries': []})
+        self.assertEqual(response.json, {'status': 'error', 'reason': 'Invalid batch'})
+        self.assertEqual(webserver.tasks_runner.metrics.get_value('asc_requests_total', labels),
+                         queued)
+
+    def test_batch_that_cant_be_queued_fails(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        with mock.patch.object(webserver.tasks_runner, 'add_batch',
+                               side_effect=RuntimeError('Queue broken')):
+            response = self.client.post('/api/batch', json={'queries': [
+                {'endpoint': 'best5', 'question': q}, {'endpoint': 'global_mean', 'question': q}]})
+        self.assertEqual(response.json['reason'], 'RuntimeError: Queue broken')
+        for job_id in response.json['job_ids']:
+            self.assertEqual(webserver.tasks_runner.job_registry.get_status(job_id), 'failed')
+
+    def test_batch_counts_its_queries(self):
+        q = 'Percent of adults who engage in no leisure-time physical activity'
+        queries = [{'endpoint': endpoint, 'question': q} for endpoint in ('best5', 'worst5',
+                                                                          'global_mean')]
+        limiter = webserver.tasks_runner.limiter
+        with mock.patch.object(limiter, 'max_depth', 2), \
+                mock.patch.object(limiter, 'soft_limit', 2):
+            response = self.client.post('/api/batch', json={'queries': queries})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(len(self.client.post('/api/batch',
+                                                  json={'queries': queries[:2]}).json['job_ids']), 2)
+        with mock.patch.object(limiter, 'max_batch', 2):
+            response = self.client.post('/api/batch', json={'queries': queries})
+        self.assertEqual(response.json, {'status': 'error',
+                                         'reason': 'Batch too large (at most 2 queries)'})
+
+
+class TestSubmitEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = webserver.test_client()
+        self.q = 'Percent of adults who engage in no leisure-time physical activity'
+
+    def test_invalid_state_is_rejected(self):
+        num_jobs = len(webserver.tasks_runner.job_registry.get_jobs())
+        response = self.client.post('/api/best5', json={'question': self.q, 'state': ['x']})
+        self.assertEqual(response.json, {'status': 'error', 'reason': 'Invalid state'})
+        # rejected before it got a job_id
+        self.assertEqual(len(webserver.tasks_runner.job_registry.get_jobs()), num_jobs)
+
+    def test_job_that_cant_be_queued_fails(self):
+        with mock.patch.object(webserver.tasks_runner, 'add_task',
+                               side_effect=RuntimeError('Queue broken')):
+            response = self.client.post('/api/global_mean', json={'question': self.q})
+        job_id = response.json['job_id']
+        self.assertEqual(response.json['status'], 'failed')
+        self.assertEqual(self.client.get(f'/api/get_results/{job_id}').json,
+                         {'status': 'failed', 'reason': 'RuntimeError: Queue broken'})
+
+    def test_inline_job_is_solved_when_queue_is_full(self):
+        limiter = webserver.tasks_runner.limiter
+        with mock.patch.object(limiter, 'max_depth', 1), \
+                mock.patch.object(webserver.tasks_runner.tasks_queue, 'qsize', return_value=1):
+            response = self.client.post('/api/global_mean?inline=1', json={'question': self.q})
+            self.assertEqual(response.json['status'], 'done')
+            response = self.client.post('/api/global_mean', json={'question': self.q})
+            self.assertEqual(response.status_code, 429)
+
+
+class TestJobTiming(unittest.TestCase):
+    def setUp(self):
+        self.client = webserver.test_client()
+        self.q = 'Percent of adults who engage in no leisure-time physical activity'
+
+    def test_done_job(self):
+        job_id = self.client.post('/api/state_mean',
+                                  json={'question': self.q, 'state': 'Wyoming'}).json['job_id']
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5&timing=1').json
+        self.assertEqual(response['status'], 'done')
+        timing = response['timing']
+        self.assertIn(timing['worker'], range(webserver.tasks_runner.num_threads))
+        self.assertLessEqual(timing['enqueued'], timing['started'])
+        self.assertLessEqual(timing['started'], timing['solved'])
+        self.assertLessEqual(timing['solved'], timing['persisted'])
+        self.assertGreaterEqual(timing['queue_wait'], 0)
+        # only returned when asked for
+        self.assertNotIn('timing', self.client.get(f'/api/get_results/{job_id}').json)
+
+    def test_failed_job(self):
+        # not validated (as in routes.py), so it fails in the worker
+        job_id = webserver.tasks_runner.job_registry.new_job()
+        webserver.tasks_runner.add_task({'question': self.q, 'state': 'Nowhere'},
+                                        'state_mean', job_id)
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5&timing=1').json
+        self.assertEqual(response['status'], 'failed')
+        self.assertLessEqual(response['timing']['started'], response['timing']['solved'])
+        self.assertNotIn('persisted', response['timing'])
+
+    def test_inline_job(self):
+        response = self.client.post('/api/global_mean?inline=1', json={'question': self.q}).json
+        self.assertEqual(response['status'], 'done')
+        response = self.client.get(f"/api/get_results/{response['job_id']}?timing=1").json
+        self.assertEqual(response['status'], 'done')
+        # no worker ran it
+        self.assertNotIn('timing', response)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,6 @@
+""" unittests - the app is imported with its log in a temporary file, not app/webserver.log """
+import os
+import tempfile
+
+os.environ.setdefault('TP_LOG_FILE',
+                      os.path.join(tempfile.mkdtemp(prefix='asc_unittests_'), 'webserver.log'))